@@ -28,8 +28,12 @@ while [ $# -gt 0 ]
 
 echo processing date: $date
 
+#stations are fetched and processed at the same time
+
 #WSRZ.10-HHZ.RT
-python ./rsam_fdsn.py WSRZ.10-HHZ.NZ ./sds $date ./workdir resp bp 2 5
+python ./rsam_fdsn.py WSRZ.10-HHZ.NZ ./sds $date ./workdir resp bp 2 5 &
 
 #WIZ.10-HHZ.RT
-python ./rsam_fdsn.py WIZ.10-HHZ.NZ ./sds $date ./workdir resp bp 2 5
+python ./rsam_fdsn.py WIZ.10-HHZ.NZ ./sds $date ./workdir resp bp 2 5 &
+
+wait
@@ -6,12 +6,13 @@
 # file length is (approximately) one day, can be a few seconds over or under so
 # file does not contain exactly 144 x 10 minute segments
 
-import numpy as np
 import sys
 import os
 from obspy.core import read, Trace, Stream
 import datetime as dt
-import urllib
+from rsam_engine import design_filter, response_rsam, trace_rsam
+from rsam_fetch import fetch_resp
+from rsam_store import update_day_index
 
 # location of geonet response files
 respdir = 'ftp://ftp.geonet.org.nz/seed/RESPONSE'
@@ -36,10 +37,6 @@ elif len(sys.argv) == 9:  # filter = bp, two frequencies given
     f1 = float(sys.argv[7])
     f2 = float(sys.argv[8])
 
-# initialise data array for rsam values
-# one extra element, just in case
-data = np.zeros(145)
-
 # get data file name and location
 site_dir = str.split(site, '.')[0] + '.' + str.split(site, '.')[2]  # DRZ.CH
 dd = dt.datetime.strptime(date, '%Y%m%d')  # into correct format
@@ -71,10 +68,10 @@ if resp == 'resp':
     # response file name
     respfile = os.path.join(respdir, station + '.' + network, 'RESP' +
                             '.' + network + '.' + station + '.' + location + '.' + channel)
-    # get response file, store locally as file called response
-    urllib.urlretrieve(respfile, 'respfile')
+    # get response file, kept locally under out_dir/resp between runs
+    respfile = fetch_resp(respfile, os.path.join(out_dir, 'resp'))
     # response info
-    seedresp = {'filename': 'respfile', 'date': starttime, 'units': 'VEL'}
+    seedresp = {'filename': respfile, 'date': starttime, 'units': 'VEL'}
     # define a filter band to prevent amplifying noise during the deconvolution
     # wide values 'typical' short-period rsam
     fl1 = 0.005
@@ -106,53 +103,24 @@ rsamfile = os.path.join(out_dir, site_dir, rsam_name)
 if not os.path.exists(rsampath):
     os.makedirs(rsampath)
 
-t = tr.stats.starttime
-index = 0
-# loop through data in 600sec (10 min) blocks
-while t < tr.stats.endtime:
-    tr_10m = tr.slice(t, t + 600)
-
-    duration = tr_10m.stats.npts * tr_10m.stats.delta
-    # print index, duration
-    if duration >= 500:
-        if duration < 600:
-            tr_10m = tr.slice(tr.stats.endtime - 600, tr.stats.endtime)
-        # correct response?
-        if resp == 'resp':
-            tr_10m.simulate(
-                paz_remove=None, pre_filt=(fl1, fl2, fl3, fl4), seedresp=seedresp)
-
-        #detrend and filter
-        tr_10m.detrend(type='constant')
-        if filtype == 'lp':
-            # print 'lowpass'
-            tr_10m.filter('lowpass', freq=f, corners=4, zerophase=False)
-        elif filtype == 'hp':
-            # print 'highpass'
-            tr_10m.filter('highpass', freq=f, corners=4, zerophase=False)
-        elif filtype == 'bp':
-            # print 'bandpass'
-            tr_10m.filter(
-                'bandpass', freqmin=f1, freqmax=f2, corners=4, zerophase=False)
-# win_cos = cosTaper(tr.stats.npts, 0.0001) #cosine taper 0.05%
-# filt = tr.data*win_cos	#filtered data
-# absolute = np.absolute(filt)	#absolute value
-# tr.data = absolute	#assign back to trace
-
-        absolute = np.absolute(tr_10m.data)  # absolute value
-        tr_10m.data = absolute  # assign back to trace
-        mean = tr_10m.data.mean()
-        if resp == 'resp':
-            # convert to nanometres so dealing with whole numbers
-            mean = mean / 1e-9
-        data[index] = mean
-        index += 1
-        # end if
-    t += 600
-# end loop through data in 600sec (10 min) blocks
+# rsam values from 600sec (10 min) blocks of the data
+if filtype == 'lp':
+    sos = design_filter('lowpass', tr.stats.sampling_rate, freq=f)
+elif filtype == 'hp':
+    sos = design_filter('highpass', tr.stats.sampling_rate, freq=f)
+elif filtype == 'bp':
+    sos = design_filter(
+        'bandpass', tr.stats.sampling_rate, freqmin=f1, freqmax=f2)
+else:
+    sos = None
 
-# resize data to remove any unused elements
-data = np.resize(data, index)
+if resp == 'resp':
+    # response is evaluated once and removed from every window, then windows are detrended and filtered
+    data = response_rsam(tr, seedresp, pre_filt=(fl1, fl2, fl3, fl4), sos=sos)
+    # convert to nanometres so dealing with whole numbers
+    data = data / 1e-9
+else:
+    data = trace_rsam(tr, sos)
 
 # write mseed format file
 # mseed header attributes
@@ -162,3 +130,4 @@ stats = {'network': network, 'station': station, 'location': location,
          'mseed': {'dataquality': 'D'}, 'starttime': starttime}
 st = Stream([Trace(data=data, header=stats)])
 st.write(rsamfile, format='MSEED', reclen=256)
+update_day_index(rsamfile, st[0])  # daily summary for the year file
@@ -6,7 +6,8 @@ import sys
 import os
 import numpy as np
 import datetime as dt
-from obspy.core import read, Trace, Stream
+from obspy.core import Trace, Stream, UTCDateTime
+from rsam_store import day_summaries
 
 # input arguments
 if (len(sys.argv) < 6) | (len(sys.argv) > 8):
@@ -37,7 +38,7 @@ dd = dt.datetime.strptime(date, '%Y%m%d')  # into correct format
 
 data = []
 y = dd.strftime("%Y")
-starttime = None
+starttime = UTCDateTime(int(y), 1, 1)  # one value per day from 1 January
 
 if filtype == 'none':
     file = '{:s}.{:>03d}' + '.' + site + '.rsam'
@@ -56,32 +57,31 @@ elif filtype == 'bp':
 
 yrsamfile = os.path.join(rsam_dir, site_dir, yfile)
 
-for j in range(int(dd.strftime("%j")) + 1):
-    rsamfile = os.path.join(rsam_dir, site_dir, file.format(y, j))
-
-    # if rsamfile exists calculate day value
-    if os.path.isfile(rsamfile):
-        # read input data file
-        st = read(rsamfile)
-        # in case stream has more than one trace
-        st.merge(fill_value='interpolate')
-        tr = st[0]
-        if starttime is None:
-            starttime = tr.stats.starttime
-        data.append(tr.data.mean())  # mean value for the day
+# day values come from the daily summary index of the rsam files, which is
+# updated whenever a day file is written, so the day files are not read again
+rsamfiles = [os.path.join(rsam_dir, site_dir, file.format(y, j))
+             for j in range(1, int(dd.strftime("%j")) + 1)]
+summary = None
+for rsamfile, day_summary in zip(rsamfiles, day_summaries(rsamfiles)):
+    # if rsamfile exists use its mean value for the day
+    if day_summary is not None:
+        summary = day_summary
+        data.append(np.nan if day_summary['mean'] is None else day_summary['mean'])
     else:
         # file does not exist, assign a value of -1 as day value
         print("Can't find file %s" % rsamfile)
         data.append(-1)
+if summary is None:
+    sys.exit("no rsam files found for %s in %s" % (site, y))
 
 if os.path.isfile(yrsamfile):
     os.unlink(yrsamfile)
 # start new year file
-station = tr.stats.station  # DRZ
-network = tr.stats.network  # CH
-location = tr.stats.location  # 10
-channel = tr.stats.channel  # EHZ
-starttime = starttime  # 2005-10-06T07:21:59.849998Z
+station = summary['station']  # DRZ
+network = summary['network']  # CH
+location = summary['location']  # 10
+channel = summary['channel']  # EHZ
+starttime = starttime  # 2005-01-01T00:00:00.000000Z
 delta = 86400  # one day interval
 npts = len(data)  # single value, mean
 # write file
@@ -0,0 +1,859 @@
+#!/usr/bin/env python
+# rsam_engine.py
+# shared 10 minute RSAM calculation used by the rsam scripts
+# time for rsam value is start of ten minute interval
+
+# windows follow the tr.slice(t, t + 600) rules of the original scripts: both
+# end samples are included, windows shorter than 500 s are dropped and a short
+# final window is replaced by the last 600 s of the trace
+
+# with day given, windows are instead aligned to the UTC 10 minute boundaries
+# of that day, giving a fixed grid of 144 slots with NaN where a slot has too
+# little data (see aligned_bounds)
+
+import numpy as np
+from obspy.core import Trace, UTCDateTime
+from obspy.signal.invsim import cosine_taper, evalresp, invert_spectrum
+from obspy.signal.util import _npts2nfft
+from scipy.signal import iirfilter, resample_poly, sosfilt, sosfilt_zi, zpk2sos
+import os
+
+WINDOW = 600  # 10 min windows between RSAM values
+MIN_DURATION = 500  # shortest window (in seconds) given an RSAM value
+BLOCK = 24  # number of windows processed together, bounds memory use
+WARMUP = 120  # filter warm-up (s) fetched before the first window of an incremental update
+DECIMATION_MARGIN = 2.5  # decimated Nyquist is kept at least this multiple of a band's upper corner
+MIN_COVERAGE = 0.9  # default fraction of a window's samples needed for an RSAM value in gap-aware mode
+
+_filter_cache = {}  # filter designs keyed by (type, sampling rate, band, corners)
+_response_cache = {}  # inverse responses keyed by (RESP file, date, units, NSLC, sampling rate, nfft, pre-filter)
+
+
+def round_away(x):
+    """Round half away from zero, as obspy does when slicing traces."""
+    return np.sign(x) * np.floor(np.abs(x) + 0.5)
+
+
+def design_filter(filter_type, sampling_rate, freq=None, freqmin=None, freqmax=None, corners=4):
+    """
+    Return second-order sections for an obspy style Butterworth filter.
+
+    Mirrors obspy.signal.filter.lowpass/highpass/bandpass, including falling
+    back to a highpass when the bandpass upper corner is at Nyquist.
+    Returns None when no filtering is required.
+    """
+    fe = 0.5 * sampling_rate
+    if filter_type is None or filter_type == 'none':
+        return None
+    if filter_type == 'bandpass':
+        low = freqmin / fe
+        high = freqmax / fe
+        if high - 1.0 > -1e-6:
+            return design_filter('highpass', sampling_rate, freq=freqmin, corners=corners)
+        if low > 1:
+            raise ValueError('Selected low corner frequency is above Nyquist.')
+        z, p, k = iirfilter(corners, [low, high], btype='band', ftype='butter', output='zpk')
+    elif filter_type == 'lowpass':
+        f = min(freq / fe, 1.0)
+        z, p, k = iirfilter(corners, f, btype='lowpass', ftype='butter', output='zpk')
+    elif filter_type == 'highpass':
+        f = freq / fe
+        if f > 1:
+            raise ValueError('Selected corner frequency is above Nyquist.')
+        z, p, k = iirfilter(corners, f, btype='highpass', ftype='butter', output='zpk')
+    else:
+        raise ValueError('Unknown filter type %s' % filter_type)
+    return zpk2sos(z, p, k)
+
+
+def cached_filter(filter_type, sampling_rate, freq=None, freqmin=None, freqmax=None, corners=4):
+    """
+    Return design_filter(...) reusing designs per sampling rate and band.
+    """
+    key = (filter_type, float(sampling_rate), freq, freqmin, freqmax, corners)
+    if key not in _filter_cache:
+        _filter_cache[key] = design_filter(filter_type, sampling_rate, freq, freqmin, freqmax, corners)
+    return _filter_cache[key]
+
+
+def band_filter(band, sampling_rate):
+    """
+    Return the cached filter design of a (filter_type, freq, freqmin, freqmax) band.
+    """
+    filter_type, freq, freqmin, freqmax = band
+    return cached_filter(filter_type, sampling_rate, freq=freq, freqmin=freqmin, freqmax=freqmax)
+
+
+def window_bounds(npts, sampling_rate, window=WINDOW, min_duration=MIN_DURATION, skip=0, complete_only=False):
+    """
+    Return (start, stop) sample indices of the RSAM windows of a trace.
+
+    Equivalent to stepping t from the trace start in window second steps and
+    taking tr.slice(t, t + window), so stop is exclusive and windows share
+    their end samples. Windows start skip samples into the trace. With
+    complete_only only windows holding the full window + 1 samples are
+    returned and no short final window is added.
+    """
+    delta = 1.0 / sampling_rate
+    if complete_only:
+        min_duration = window + 0.5 * delta
+    npts -= skip
+    length = (npts - 1) * delta  # trace endtime - starttime
+    offsets = np.arange(0, length, window, dtype=np.float64)
+    start = round_away(offsets * sampling_rate).astype(np.int64)
+    stop = npts - np.maximum(round_away((length - offsets - window) * sampling_rate), 0).astype(np.int64)
+    duration = (stop - start) * delta
+    keep = duration >= min_duration
+    start, stop, duration = start[keep], stop[keep], duration[keep]
+
+    # a short final window is replaced by the last full window of the trace
+    short = duration < window
+    start[short] = max(npts - 1 - int(round_away(window * sampling_rate)), 0)
+    stop[short] = npts
+    return start + skip, stop + skip
+
+
+def aligned_bounds(starttime, npts, sampling_rate, day, window=WINDOW, min_duration=MIN_DURATION,
+                   first_window=None, complete_only=False):
+    """
+    Return (start, stop, slots) sample indices and grid slots of the clock-aligned windows of data.
+
+    The day is divided into slots of window seconds from its UTC midnight;
+    slot k holds the samples from day + k * window to day + (k + 1) *
+    window, both included as with tr.slice. Slots with less than
+    min_duration of data, or with complete_only less than the full window,
+    are left out, as are slots starting before first_window.
+    """
+    day = UTCDateTime(day)
+    n_slots = int(round(86400.0 / window))
+    slots = np.arange(n_slots)
+    offsets = slots * float(window) + (day - UTCDateTime(starttime))  # slot starts in seconds from the first sample
+    start = np.clip(np.ceil(offsets * sampling_rate - 1e-6), 0, npts).astype(np.int64)
+    stop = np.clip(np.floor((offsets + window) * sampling_rate + 1e-6) + 1, 0, npts).astype(np.int64)
+    duration = (stop - start) / float(sampling_rate)
+    if complete_only:
+        min_duration = window - 0.5 / sampling_rate  # off-grid samples give window * sampling_rate per slot
+    keep = duration >= min_duration
+    if first_window is not None:
+        keep &= offsets >= UTCDateTime(first_window) - UTCDateTime(starttime) - 0.5 / sampling_rate
+    return start[keep], stop[keep], slots[keep]
+
+
+def grid_values(values, slots, n_slots=None, window=WINDOW):
+    """
+    Return values of aligned windows (last axis) placed on the day's full grid of slots, NaN elsewhere.
+    """
+    if n_slots is None:
+        n_slots = int(round(86400.0 / window))
+    values = np.asarray(values)
+    grid = np.full(values.shape[:-1] + (n_slots,), np.nan)
+    grid[..., slots] = values
+    return grid
+
+
+def slot_index(time, window=WINDOW):
+    """
+    Return (day, slot) of the clock-aligned window holding a time, the UTC midnight of its day and its grid index.
+    """
+    time = UTCDateTime(time)
+    day = UTCDateTime(time.date)
+    return day, int((time - day) // window)
+
+
+def trace_grid(values, tr, day, window=WINDOW, min_duration=MIN_DURATION, first_window=None, complete_only=False):
+    """
+    Return the values of a trace's aligned windows (see trace_windows) on the day's full grid of slots.
+    """
+    slots = aligned_bounds(tr.stats.starttime, tr.stats.npts, tr.stats.sampling_rate, day, window, min_duration,
+                           first_window, complete_only)[2]
+    return grid_values(values, slots, window=window)
+
+
+def trace_windows(tr, window=WINDOW, min_duration=MIN_DURATION, first_window=None, complete_only=False, day=None):
+    """
+    Return (start, stop) sample indices of the RSAM windows of a trace.
+
+    Windows start at the sample nearest first_window when it is given, so
+    leading data (e.g. filter warm-up) can be excluded from the windows.
+    With day given the windows are the clock-aligned slots of that day
+    holding data (see aligned_bounds).
+    """
+    if day is not None:
+        return aligned_bounds(tr.stats.starttime, tr.stats.npts, tr.stats.sampling_rate, day, window, min_duration,
+                              first_window, complete_only)[:2]
+    skip = 0
+    if first_window is not None:
+        skip = int(round_away((first_window - tr.stats.starttime) * tr.stats.sampling_rate))
+        skip = min(max(skip, 0), tr.stats.npts)
+    return window_bounds(tr.stats.npts, tr.stats.sampling_rate, window, min_duration, skip, complete_only)
+
+
+def window_means(data, start, stop, sos=None, block=BLOCK):
+    """
+    Detrend, filter and take the mean absolute value of each window.
+    """
+    return window_bank_means(data, start, stop, [sos], block)[0]
+
+
+def window_bank_means(data, start, stop, sos_bank, block=BLOCK):
+    """
+    Return the mean absolute value of each window for every filter of a bank.
+
+    Windows of equal length are stacked into a (n_windows, samples) array and
+    processed as batched numpy operations, block windows at a time. Each block
+    is read and detrended once and then run through every filter in sos_bank
+    (None for no filtering), giving an (n_filters, n_windows) array.
+    """
+    data = np.ascontiguousarray(data, dtype=np.float64)
+    means = np.zeros((len(sos_bank), len(start)))
+    for length in np.unique(stop - start):
+        idx = np.flatnonzero(stop - start == length)
+        for b in range(0, len(idx), block):
+            rows = idx[b:b + block]
+            windows = data[start[rows][:, np.newaxis] + np.arange(length)]
+            windows -= windows.mean(axis=1)[:, np.newaxis]  # detrend (constant)
+            for m, sos in enumerate(sos_bank):
+                if sos is None:
+                    filtered = windows
+                else:
+                    filtered = sosfilt(sos, windows, axis=1)
+                means[m, rows] = np.absolute(filtered).mean(axis=1)
+    return means
+
+
+def trace_rsam(tr, sos=None, window=WINDOW, min_duration=MIN_DURATION):
+    """
+    Return the 10 minute RSAM values of a (merged) trace.
+    """
+    return filter_bank_rsam(tr, [sos], window, min_duration)[0]
+
+
+def filter_bank_rsam(tr, sos_bank, window=WINDOW, min_duration=MIN_DURATION,
+                     first_window=None, complete_only=False, day=None):
+    """
+    Return the 10 minute RSAM values of a trace for every filter of a bank.
+
+    Gives an (n_filters, n_windows) array from a single read of the samples,
+    or with day given an (n_filters, n_slots) array on the day's grid.
+    """
+    start, stop = trace_windows(tr, window, min_duration, first_window, complete_only, day)
+    means = window_bank_means(tr.data, start, stop, sos_bank)
+    if day is not None:
+        means = trace_grid(means, tr, day, window, min_duration, first_window, complete_only)
+    return means
+
+
+def gap_bank_rsam(st, sos_bank, min_coverage=MIN_COVERAGE, window=WINDOW, min_duration=MIN_DURATION,
+                  first_window=None, complete_only=False, day=None):
+    """
+    Return (means, coverage) for the windows of an unmerged stream of contiguous traces.
+
+    Windows lie where they would on the trace given by merging the stream,
+    but no merged copy is made: windows within one trace are read from it
+    directly and a window spanning a gap is interpolated across the gap on
+    its own. means is (n_filters, n_windows) with NaN for windows holding
+    less than min_coverage of their samples; coverage is the fraction of
+    each window's samples present in the stream. With day given both are
+    on the day's grid of clock-aligned slots, where coverage is relative to
+    a full window.
+    """
+    traces = sorted([tr for tr in st if tr.stats.npts > 0], key=lambda tr: tr.stats.starttime)
+    traces = [tr for tr in traces if tr.stats.sampling_rate == traces[0].stats.sampling_rate]
+    sampling_rate = traces[0].stats.sampling_rate
+    t0 = traces[0].stats.starttime
+    offsets = [int(round_away((tr.stats.starttime - t0) * sampling_rate)) for tr in traces]
+    npts = max(offset + tr.stats.npts for offset, tr in zip(offsets, traces))
+    if day is None:
+        skip = 0
+        if first_window is not None:
+            skip = min(max(int(round_away((first_window - t0) * sampling_rate)), 0), npts)
+        start, stop = window_bounds(npts, sampling_rate, window, min_duration, skip, complete_only)
+        expected = stop - start
+    else:
+        start, stop, slots = aligned_bounds(t0, npts, sampling_rate, day, window, 0, first_window, complete_only)
+        expected = int(round_away(window * sampling_rate))  # samples in a full slot, one more when on the grid
+
+    present = np.zeros(len(start))
+    for offset, tr in zip(offsets, traces):
+        present += np.clip(np.minimum(stop, offset + tr.stats.npts) - np.maximum(start, offset), 0, None)
+    coverage = np.minimum(present / expected, 1.0)
+
+    means = np.full((len(sos_bank), len(start)), np.nan)
+    done = coverage < min_coverage
+    for offset, tr in zip(offsets, traces):
+        inside = np.flatnonzero(~done & (start >= offset) & (stop <= offset + tr.stats.npts) & (stop > start))
+        if len(inside) > 0:
+            means[:, inside] = window_bank_means(tr.data, start[inside] - offset, stop[inside] - offset, sos_bank)
+            done[inside] = True
+    for n in np.flatnonzero(~done & (coverage > 0)):
+        index = []
+        values = []
+        for offset, tr in zip(offsets, traces):
+            first = max(start[n] - offset, 0)
+            last = min(stop[n] - offset, tr.stats.npts)
+            if first < last:
+                index.append(np.arange(first, last) + offset)
+                values.append(np.asarray(tr.data[first:last], dtype=np.float64))
+        index, unique = np.unique(np.concatenate(index), return_index=True)  # overlapping samples are used once
+        data = np.interp(np.arange(start[n], stop[n]), index, np.concatenate(values)[unique])
+        means[:, n] = window_bank_means(data, np.array([0]), np.array([len(data)]), sos_bank)[:, 0]
+    if day is not None:
+        return grid_values(means, slots, window=window), grid_values(coverage, slots, window=window)
+    return means, coverage
+
+
+def response_transfer(seedresp, sampling_rate, nfft, pre_filt=None, water_level=600):
+    """
+    Return the pre-filtered inverse instrument response of a RESP file for an rfft of nfft points.
+
+    This is the frequency domain factor Trace.simulate(seedresp=...) applies
+    to each window; it is evaluated once per RESP file, sampling rate and
+    window length and reused.
+    """
+    key = (seedresp['filename'], str(seedresp['date']), seedresp['units'], seedresp['network'],
+           seedresp['station'], seedresp['location'], seedresp['channel'], float(sampling_rate), nfft,
+           pre_filt, water_level)
+    if key not in _response_cache:
+        freq_response, freqs = evalresp(1.0 / sampling_rate, nfft, seedresp['filename'], seedresp['date'],
+                                        units=seedresp['units'], freq=True, network=seedresp['network'],
+                                        station=seedresp['station'], locid=seedresp['location'],
+                                        channel=seedresp['channel'])
+        invert_spectrum(freq_response, water_level)
+        if pre_filt:
+            freq_response *= cosine_taper(freqs.size, freqs=freqs, flimit=pre_filt)
+        _response_cache[key] = freq_response
+    return _response_cache[key]
+
+
+def response_window_means(data, start, stop, seedresp, sampling_rate, pre_filt=None, sos=None, block=BLOCK):
+    """
+    Remove the instrument response, detrend, filter and take the mean absolute value of each window.
+
+    Gives the same values as Trace.simulate(seedresp=seedresp,
+    pre_filt=pre_filt), detrend('constant') and sosfilt on each window, but
+    windows of equal length are processed block windows at a time with one
+    response evaluation per window length.
+    """
+    data = np.ascontiguousarray(data, dtype=np.float64)
+    means = np.zeros(len(start))
+    for length in np.unique(stop - start):
+        idx = np.flatnonzero(stop - start == length)
+        nfft = _npts2nfft(length)
+        transfer = response_transfer(seedresp, sampling_rate, nfft, pre_filt)
+        taper = cosine_taper(length, 0.05)
+        trend = np.arange(length) / float(length - 1)
+        for b in range(0, len(idx), block):
+            rows = idx[b:b + block]
+            windows = data[start[rows][:, np.newaxis] + np.arange(length)]
+            windows -= windows.mean(axis=1)[:, np.newaxis]
+            windows *= taper
+            spectra = np.fft.rfft(windows, n=nfft, axis=1)
+            spectra *= transfer
+            spectra[:, -1] = np.abs(spectra[:, -1])
+            windows = np.fft.irfft(spectra, n=nfft, axis=1)[:, :length]
+            windows -= windows[:, :1] + trend * (windows[:, -1:] - windows[:, :1])  # as obspy's simple_detrend
+            windows -= windows.mean(axis=1)[:, np.newaxis]  # detrend (constant)
+            if sos is not None:
+                windows = sosfilt(sos, windows, axis=1)
+            means[rows] = np.absolute(windows).mean(axis=1)
+    return means
+
+
+def response_rsam(tr, seedresp, pre_filt=None, sos=None, window=WINDOW, min_duration=MIN_DURATION):
+    """
+    Return the 10 minute RSAM values of a trace with the instrument response of a RESP file removed.
+    """
+    seedresp = dict(seedresp)
+    seedresp.setdefault('date', tr.stats.starttime)
+    for item in ['network', 'station', 'location', 'channel']:
+        seedresp[item] = tr.stats[item]
+    start, stop = window_bounds(tr.stats.npts, tr.stats.sampling_rate, window, min_duration)
+    return response_window_means(tr.data, start, stop, seedresp, tr.stats.sampling_rate, pre_filt, sos)
+
+
+def continuous_rsam(tr, sos=None, state=None, window=WINDOW, min_duration=MIN_DURATION):
+    """
+    Return RSAM values filtering the whole trace in one pass, and the end state.
+
+    The filter runs continuously across window boundaries instead of being
+    restarted for every window, so windows carry no start-up transient. The
+    trace offset is removed before filtering and each filtered window is
+    demeaned before taking its mean absolute value. state is an
+    (offset, zi) tuple from a previous call on the preceding data; when it
+    is None the filter starts in steady state on the first sample.
+    """
+    means, states = continuous_bank_rsam(tr, [sos], [state], window, min_duration)
+    return means[0], states[0]
+
+
+def continuous_bank_rsam(tr, sos_bank, states=None, window=WINDOW, min_duration=MIN_DURATION,
+                         first_window=None, complete_only=False, day=None, state_time=None):
+    """
+    Return continuous-filter RSAM values and end states for a bank of filters.
+
+    As continuous_rsam, with one (offset, zi) state (or None) per filter.
+    With day given the values are on the day's grid of aligned slots. With
+    state_time given the returned states are those the filters reach just
+    before the first sample at or after state_time (see state_index).
+    """
+    data = np.asarray(tr.data, dtype=np.float64)
+    if states is None:
+        states = [None] * len(sos_bank)
+    start, stop = trace_windows(tr, window, min_duration, first_window, complete_only, day)
+    split = state_index(tr.stats, state_time)
+    means = np.zeros((len(sos_bank), len(start)))
+    end_states = []
+    mean = None
+    for m, (sos, state) in enumerate(zip(sos_bank, states)):
+        if state is None:
+            if mean is None:
+                mean = data.mean()
+            offset = mean
+            zi = None if sos is None else sosfilt_zi(sos) * (data[0] - offset)
+        else:
+            offset, zi = state
+        if sos is None:
+            filtered = data - offset
+        else:
+            filtered, zi = split_sosfilt(sos, data - offset, zi, split)[:2]
+        means[m] = window_bank_means(filtered, start, stop, [None])[0]
+        end_states.append((offset, zi))
+    if day is not None:
+        means = trace_grid(means, tr, day, window, min_duration, first_window, complete_only)
+    return means, end_states
+
+
+def split_sosfilt(sos, x, zi, split):
+    """
+    Return sosfilt(sos, x, zi=zi) and the filter states before sample split and after the last sample.
+    """
+    filtered = np.zeros(len(x))
+    states = []
+    for part in [slice(0, split), slice(split, len(x))]:
+        if part.stop > part.start:
+            filtered[part], zi = sosfilt(sos, x[part], zi=zi)
+        states.append(zi)
+    return filtered, states[0], states[1]
+
+
+# Filter state between days
+#
+# FDSN servers trim inclusively, so one day's data usually ends with the
+# sample at the next midnight, which is also the first sample of the next
+# day. The state is therefore saved just before the first sample at or after
+# the end of the day rather than after the last sample of the trace, so it
+# continues into the next day's trace whether or not that sample is shared.
+
+def state_index(stats, state_time=None):
+    """
+    Return the index of the first sample at or after state_time of a trace with header stats.
+
+    Without state_time, or when the trace ends before it, this is npts.
+    """
+    if state_time is None:
+        return stats.npts
+    index = int(np.ceil((state_time - stats.starttime) * stats.sampling_rate - 0.5))
+    return min(max(index, 0), stats.npts)
+
+
+def save_filter_state(path, state, stats, sos, state_time=None):
+    """
+    Save the filter state reached before sample state_index(stats, state_time) so the next run can continue it.
+    """
+    offset, zi = state
+    if sos is None:
+        return
+    np.savez(path,
+             offset=offset,
+             zi=zi,
+             sos=sos,
+             sampling_rate=stats.sampling_rate,
+             next_start=(stats.starttime + state_index(stats, state_time) * stats.delta).timestamp)
+
+
+def load_filter_state(path, tr, sos):
+    """
+    Return the saved (offset, zi) state if it continues directly into trace tr.
+
+    The state is only used when the trace starts at the sample the state was
+    saved before, with the same sampling rate and filter; otherwise None is
+    returned and the filter starts afresh.
+    """
+    if sos is None or not os.path.isfile(path):
+        return None
+    saved = np.load(path)
+    if saved['sampling_rate'] != tr.stats.sampling_rate:
+        reason = 'a sampling rate of %g Hz' % saved['sampling_rate']
+    elif saved['sos'].shape != sos.shape or not np.allclose(saved['sos'], sos):
+        reason = 'a different filter'
+    elif abs(tr.stats.starttime.timestamp - float(saved['next_start'])) > 0.5 * tr.stats.delta:
+        reason = 'data continuing at ' + str(UTCDateTime(float(saved['next_start'])))
+    else:
+        return float(saved['offset']), saved['zi']
+    print('Not continuing filter state ' + path + ' saved for ' + reason + ' into ' + tr.id + ' from ' +
+          str(tr.stats.starttime) + ', restarting the filter')
+    return None
+
+
+# Streaming RSAM
+#
+# A day can be passed to StreamingRSAM in consecutive chunks (e.g. one hour
+# fetched at a time). Each chunk is run through the filters with the state
+# carried from the previous chunk and the windows it completes are returned
+# at once, so only the current chunk and the last window of filtered data are
+# held in memory. The results are those of continuous_bank_rsam with the
+# offset taken from the first chunk instead of the whole day.
+
+class StreamingRSAM(object):
+    """
+    Continuous-filter RSAM of a trace arriving in consecutive chunks.
+
+    Samples missing between chunks are filled by linear interpolation and
+    samples repeated at chunk edges are dropped, as merging the chunks with
+    fill_value='interpolate' would. states optionally gives one (offset, zi)
+    state (or None) per filter to continue from; end_states are the states
+    reached before the first sample at or after state_time, as for
+    continuous_bank_rsam.
+    """
+
+    def __init__(self, sos_bank, states=None, window=WINDOW, min_duration=MIN_DURATION, state_time=None):
+        self.sos_bank = sos_bank
+        self.states = [None] * len(sos_bank) if states is None else list(states)
+        self.state_time = state_time
+        self.end_states = None  # states at state_time, once reached
+        self.window = window
+        self.min_duration = min_duration
+        self.stats = None  # header of the data received so far
+        self.npts = 0
+        self.last = None  # last sample received
+        self.buffer = np.zeros((len(sos_bank), 0))  # filtered samples from buffer_start on
+        self.buffer_start = 0
+        self.emitted = 0  # number of windows already returned
+
+    def add(self, tr):
+        """
+        Filter the next chunk of data and return an (n_filters, n_windows) array of the windows it completes.
+        """
+        data = np.asarray(tr.data, dtype=np.float64)
+        if self.stats is None:
+            self.stats = tr.stats.copy()
+        else:
+            first = int(round_away((tr.stats.starttime - self.stats.starttime) * self.stats.sampling_rate))
+            if first < self.npts:
+                data = data[self.npts - first:]
+            elif first > self.npts and len(data) > 0:
+                gap = np.linspace(self.last, data[0], first - self.npts + 2)[1:-1]
+                data = np.concatenate([gap, data])
+        if len(data) == 0:
+            return np.zeros((len(self.sos_bank), 0))
+
+        split = len(data)
+        if self.state_time is not None and self.end_states is None:
+            split = int(np.ceil((self.state_time - self.stats.starttime) * self.stats.sampling_rate - 0.5))
+            split = min(max(split - self.npts, 0), len(data))
+        filtered = np.zeros((len(self.sos_bank), len(data)))
+        split_states = []
+        for m, (sos, state) in enumerate(zip(self.sos_bank, self.states)):
+            if state is None:
+                offset = data.mean()
+                zi = None if sos is None else sosfilt_zi(sos) * (data[0] - offset)
+            else:
+                offset, zi = state
+            if sos is None:
+                filtered[m] = data - offset
+                split_states.append((offset, zi))
+            else:
+                filtered[m], split_zi, zi = split_sosfilt(sos, data - offset, zi, split)
+                split_states.append((offset, split_zi))
+            self.states[m] = (offset, zi)
+        if split < len(data):
+            self.end_states = split_states
+        self.buffer = np.hstack([self.buffer, filtered])
+        self.npts += len(data)
+        self.last = data[-1]
+        self.stats.npts = self.npts
+
+        start, stop = window_bounds(self.npts, self.stats.sampling_rate, self.window, self.min_duration,
+                                    complete_only=True)
+        means = self.window_means(start[self.emitted:], stop[self.emitted:])
+        self.emitted = len(start)
+
+        # keep the data of the next window and of the last full window, which may replace a short final window
+        keep = self.npts - 1 - int(round_away(self.window * self.stats.sampling_rate))
+        if self.emitted < len(start):
+            keep = min(keep, start[self.emitted])
+        else:
+            keep = min(keep, stop[-1] - 1 if len(stop) else 0)
+        if keep > self.buffer_start:
+            self.buffer = self.buffer[:, keep - self.buffer_start:]
+            self.buffer_start = keep
+        return means
+
+    def finish(self):
+        """
+        Return an (n_filters, n_windows) array of the windows left at the end of the data.
+
+        These are the incomplete windows window_bounds gives, including a
+        short final window replaced by the last full window.
+        """
+        if self.end_states is None:
+            self.end_states = list(self.states)
+        if self.stats is None:
+            return np.zeros((len(self.sos_bank), 0))
+        start, stop = window_bounds(self.npts, self.stats.sampling_rate, self.window, self.min_duration)
+        means = self.window_means(start[self.emitted:], stop[self.emitted:])
+        self.emitted = len(start)
+        return means
+
+    def window_means(self, start, stop):
+        means = np.zeros((len(self.sos_bank), len(start)))
+        for m in range(len(self.sos_bank)):
+            means[m] = window_bank_means(self.buffer[m], start - self.buffer_start, stop - self.buffer_start, [None])[0]
+        return means
+
+
+# Spectral RSAM
+#
+# Instead of running one IIR filter per band, each 10 minute window is
+# detrended, Hann tapered and transformed once; the energy of every band is
+# then summed from the same one-sided power spectrum. The band mean square
+# amplitude is converted to a mean absolute amplitude assuming Gaussian
+# amplitudes (mean |x| = sqrt(2 / pi) * rms) so values are comparable with,
+# but not identical to, time-domain RSAM: bands have brick-wall edges rather
+# than Butterworth roll-off.
+
+def band_limits(band, sampling_rate):
+    """
+    Return the (fmin, fmax) frequency limits of a band for spectral RSAM.
+    """
+    filter_type, freq, freqmin, freqmax = band
+    nyquist = 0.5 * sampling_rate
+    if filter_type == 'lowpass':
+        return 0.0, min(freq, nyquist)
+    elif filter_type == 'highpass':
+        return freq, nyquist
+    elif filter_type == 'bandpass':
+        return freqmin, min(freqmax, nyquist)
+    return 0.0, nyquist
+
+
+def window_power(windows, delta):
+    """
+    Return (frequencies, power) of detrended windows, one row per window.
+
+    Power is one-sided and scaled so that summing it over all frequencies
+    gives the mean square amplitude of the window.
+    """
+    length = windows.shape[1]
+    taper = np.hanning(length)
+    power = np.absolute(np.fft.rfft(windows * taper, axis=1)) ** 2 / (length * np.sum(taper ** 2))
+    if length % 2 == 0:
+        power[:, 1:-1] *= 2
+    else:
+        power[:, 1:] *= 2
+    return np.fft.rfftfreq(length, delta), power
+
+
+def window_spectra(tr, bands=(), edges=None, window=WINDOW, min_duration=MIN_DURATION,
+                   first_window=None, complete_only=False, block=BLOCK, day=None):
+    """
+    Return spectral RSAM values and binned power spectra of a trace's windows.
+
+    One FFT is taken per window. Every band is integrated from it into an
+    (n_bands, n_windows) array of spectral RSAM values and, when edges are
+    given, the power is also summed into the frequency bins they define,
+    giving an (n_windows, n_bins) array (None otherwise). With day given
+    the spectral RSAM values are on the day's grid of aligned slots, while
+    the binned spectra are only given for the slots holding data.
+    """
+    start, stop = trace_windows(tr, window, min_duration, first_window, complete_only, day)
+    data = np.ascontiguousarray(tr.data, dtype=np.float64)
+    means = np.zeros((len(bands), len(start)))
+    binned = None if edges is None else np.zeros((len(start), len(edges) - 1))
+    limits = [band_limits(band, tr.stats.sampling_rate) for band in bands]
+    for length in np.unique(stop - start):
+        idx = np.flatnonzero(stop - start == length)
+        for b in range(0, len(idx), block):
+            rows = idx[b:b + block]
+            windows = data[start[rows][:, np.newaxis] + np.arange(length)]
+            windows -= windows.mean(axis=1)[:, np.newaxis]  # detrend (constant)
+            frequencies, power = window_power(windows, tr.stats.delta)
+            for m, (fmin, fmax) in enumerate(limits):
+                in_band = (frequencies >= fmin) & (frequencies <= fmax) & (frequencies > 0)
+                means[m, rows] = np.sqrt(2 / np.pi * power[:, in_band].sum(axis=1))
+            if edges is not None:
+                cumulative = np.hstack([np.zeros((len(rows), 1)), np.cumsum(power, axis=1)])
+                bounds = np.searchsorted(frequencies, edges)
+                binned[rows] = cumulative[:, bounds[1:]] - cumulative[:, bounds[:-1]]
+    if day is not None:
+        means = trace_grid(means, tr, day, window, min_duration, first_window, complete_only)
+    return means, binned
+
+
+def spectral_bank_rsam(tr, bands, window=WINDOW, min_duration=MIN_DURATION,
+                       first_window=None, complete_only=False, day=None):
+    """
+    Return an (n_bands, n_windows) array of spectral RSAM values of a trace.
+
+    One FFT is taken per window and every band is integrated from it.
+    """
+    return window_spectra(tr, bands, window=window, min_duration=min_duration,
+                          first_window=first_window, complete_only=complete_only, day=day)[0]
+
+
+# Stored spectra
+#
+# The power of each window can be kept as log-spaced frequency bins
+# (YYYY.JJJ.<stream>.spectra.npz next to the RSAM files) so spectral RSAM
+# for a new band can later be derived without the waveforms. Bins cut by a
+# band edge contribute in proportion to their overlap with the band, so
+# bands only a few bins wide (at 40 bins per decade, narrower than about
+# 20 % of their centre frequency) are less accurate than direct spectral RSAM.
+
+SPECTRUM_FMIN = 0.5 / WINDOW  # below the lowest non-zero frequency of a 10 min window
+SPECTRUM_BINS_PER_DECADE = 40
+
+
+def spectrum_edges(sampling_rate, fmin=SPECTRUM_FMIN, bins_per_decade=SPECTRUM_BINS_PER_DECADE):
+    """
+    Return log-spaced frequency bin edges from fmin up to the Nyquist frequency.
+    """
+    nyquist = 0.5 * sampling_rate
+    n_bins = int(np.ceil(np.log10(nyquist / fmin) * bins_per_decade))
+    return np.logspace(np.log10(fmin), np.log10(nyquist), n_bins + 1)
+
+
+def save_spectra(path, tr, edges, binned, starttime=None):
+    """
+    Save binned window spectra of a trace, as returned by window_spectra.
+
+    starttime is that of the first window, the trace start by default.
+    """
+    if starttime is None:
+        starttime = tr.stats.starttime
+    np.savez_compressed(path,
+                        starttime=UTCDateTime(starttime).timestamp,
+                        sampling_rate=tr.stats.sampling_rate,
+                        edges=edges,
+                        power=binned.astype(np.float32))
+
+
+def load_spectra(path):
+    """
+    Return (starttime, sampling_rate, edges, power) from a saved spectra file.
+    """
+    saved = np.load(path)
+    return (UTCDateTime(float(saved['starttime'])),
+            float(saved['sampling_rate']),
+            saved['edges'],
+            saved['power'].astype(np.float64))
+
+
+def binned_band_rsam(edges, power, band, sampling_rate):
+    """
+    Return spectral RSAM values of a band from binned window spectra.
+    """
+    fmin, fmax = band_limits(band, sampling_rate)
+    overlap = np.minimum(edges[1:], fmax) - np.maximum(edges[:-1], fmin)
+    fraction = np.clip(overlap / np.diff(edges), 0, 1)
+    return np.sqrt(2 / np.pi * power.dot(fraction))
+
+
+# Multirate front-end
+#
+# Low frequency bands only need a fraction of the recorded bandwidth, so the
+# trace can be anti-alias decimated before the band filter is applied. The
+# decimation factor keeps the decimated Nyquist at least DECIMATION_MARGIN
+# times the band's upper corner. decimation_accuracy() (rsamtools.py
+# --decimate-check) compares the result against the full-rate calculation; on
+# synthetic 100 Hz days (random walk plus white noise) the largest window
+# difference stayed below 1 % for 0.5-1 Hz (factor 20), 2-5 Hz (factor 4) and
+# 5 Hz lowpass (factor 4) bands, with median differences of 0.1-0.4 %.
+
+def decimation_factor(sampling_rate, band, margin=DECIMATION_MARGIN):
+    """
+    Return the integer decimation factor a band allows (1 for no decimation).
+    """
+    filter_type, freq, freqmin, freqmax = band
+    if filter_type == 'lowpass':
+        fmax = freq
+    elif filter_type == 'bandpass':
+        fmax = freqmax
+    else:
+        return 1
+    return max(int(sampling_rate / (2.0 * margin * fmax)), 1)
+
+
+def decimate_trace(tr, factor):
+    """
+    Return tr anti-alias decimated by an integer factor with a polyphase FIR.
+
+    The data are padded with their edge values before resampling so the
+    zero padding of resample_poly does not put a step into the first and
+    last windows.
+    """
+    if factor == 1:
+        return tr
+    data = np.asarray(tr.data, dtype=np.float64)
+    pad = 20 * factor  # longer than half the resample_poly FIR
+    data = np.concatenate([np.full(pad, data[0]), data, np.full(pad, data[-1])])
+    data = resample_poly(data, 1, factor)[pad // factor:pad // factor + (tr.stats.npts + factor - 1) // factor]
+    stats = tr.stats.copy()
+    stats.sampling_rate = tr.stats.sampling_rate / factor
+    stats.npts = len(data)
+    return Trace(data=np.ascontiguousarray(data), header=stats)
+
+
+def rsam_bands(tr, bands, decimate=False, continuous=False, state_files=None, first_window=None, complete_only=False,
+               day=None, state_time=None):
+    """
+    Return a list with the 10 minute RSAM values of tr for every band.
+
+    bands are (filter_type, freq, freqmin, freqmax) tuples. Bands sharing a
+    decimation factor are computed together from one decimated trace when
+    decimate is set. With continuous set the filters run over the whole
+    trace (see continuous_rsam); state_files then optionally gives one
+    (previous_day_file, this_day_file) pair per band for carrying the filter
+    state between days, saved at state_time (see save_filter_state).
+    first_window, complete_only and day are as for trace_windows and
+    window_bounds.
+    """
+    groups = {}
+    for m, band in enumerate(bands):
+        factor = decimation_factor(tr.stats.sampling_rate, band) if decimate else 1
+        groups.setdefault(factor, []).append(m)
+    means = [None] * len(bands)
+    for factor in sorted(groups):
+        members = groups[factor]
+        tr_band = decimate_trace(tr, factor)
+        sos_bank = [band_filter(bands[m], tr_band.stats.sampling_rate) for m in members]
+        if continuous:
+            states = None
+            if state_files is not None:
+                states = [load_filter_state(state_files[m][0], tr_band, sos) for m, sos in zip(members, sos_bank)]
+            bank, states = continuous_bank_rsam(tr_band, sos_bank, states, first_window=first_window,
+                                                complete_only=complete_only, day=day, state_time=state_time)
+            if state_files is not None:
+                for m, sos, state in zip(members, sos_bank, states):
+                    save_filter_state(state_files[m][1], state, tr_band.stats, sos, state_time)
+        else:
+            bank = filter_bank_rsam(tr_band, sos_bank, first_window=first_window, complete_only=complete_only,
+                                    day=day)
+        for m, values in zip(members, bank):
+            means[m] = values
+    return means
+
+
+def decimation_accuracy(tr, bands):
+    """
+    Return the largest relative difference of decimated from full-rate RSAM per band.
+
+    Returns NaN for a band whose decimated and full-rate window counts differ.
+    """
+    errors = []
+    for full, decimated in zip(rsam_bands(tr, bands), rsam_bands(tr, bands, decimate=True)):
+        if len(full) == 0 or len(full) != len(decimated):
+            errors.append(np.nan)
+        else:
+            errors.append(np.max(np.abs(decimated - full) / np.abs(full)))
+    return errors
@@ -6,12 +6,13 @@
 #file length is (approximately) one day, can be a few seconds over or under so
 #file does not contain exactly 144 x 10 minute segments
 
-import numpy as np
 import sys
 import os
-from obspy.core import read, Trace, Stream, UTCDateTime
-from obspy.clients.fdsn import Client
+from obspy.core import Trace, Stream
 import datetime as dt
+from rsam_engine import design_filter, trace_rsam
+from rsam_fetch import fetch_day, SensitivityCache, WaveformCache
+from rsam_store import update_day_index
 
 #GeoNet's FDSN web servers
 arc_client = 'http://service.geonet.org.nz'
@@ -36,10 +37,6 @@ elif len(sys.argv) == 9:  #filter = bp, two frequencies given
   f1 = float(sys.argv[7])
   f2 = float(sys.argv[8])
 
-#initialise data array for rsam values
-#one extra element, just in case
-data = np.zeros(145)
-
 #get data file name and location
 net = str.split(stream, '.')[2]	#NZ
 site = str.split(stream, '.')[0]	#DRZ
@@ -51,31 +48,22 @@ data_dir = '/tmp'
 name = net + '.' + site + '.' + loc + '.' + cmp + '.' + 'D' + '.' + dd.strftime("%Y.%j")	#NZ.WIZ.10.HHZ.D.2013.121
 datafile = os.path.join(data_dir, name)	#/geonet/seismic/sds/2013/NZ/WIZ/HHZ.D/NZ.WIZ.10.HHZ.D.2013.121
 
+#near real time service first, then archive; completed days are kept in an
+#SDS layout waveform cache under data_dir
 if net == 'NZ':
-    start = UTCDateTime(dd)
-    end = start + 86400
-    try:
-        c = Client(base_url=nrt_client)
-        st = c.get_waveforms(net,site,loc,cmp,start,end,attach_response=True)
-    except: 
-        try:
-            c = Client(base_url=arc_client)
-            st = c.get_waveforms(net,site,loc,cmp,start,end,attach_response=True)
-        except:
-            sys.stderr.write("No data found for %s\n"%('.'.join((net, site, loc, cmp))))
-            sys.exit(0)
-elif net == 'IU':
-    # For IU use IRIS FDSNws
-    c = Client('IRIS')
-    start = UTCDateTime(dd)
-    end = start + 86400
-    st = c.get_waveforms(net,site,loc,cmp,start,end,attach_response=True)
+  services = [nrt_client, arc_client]
 else:
-    raise Exception("Don't know how to request data for network {:s}".format(net))
+  services = None	#default services for the network, IRIS FDSNws for IU
+st = fetch_day(net, site, loc, cmp, dd, cache=WaveformCache(base_dir), services=services)
+if st is None:
+  sys.stderr.write("No data found for %s\n"%('.'.join((net, site, loc, cmp))))
+  sys.exit(0)
 
 #prepare data stream
+#sensitivity is cached under out_dir, outside the waveform cache so it is never evicted, so no station service
+#request is needed
 if resp == 'resp':
-    st.remove_sensitivity()
+    SensitivityCache(os.path.join(out_dir, 'sensitivity_cache.json')).remove_sensitivity(st, services)
 st.merge(fill_value = 'interpolate')    #in case stream has more than one trace
 tr = st[0]
 
@@ -104,42 +92,18 @@ rsamfile = os.path.join(out_dir, site + '.' + net, rsam_name)	#out_dir/DRZ.CH/20
 if not os.path.exists(rsampath):
   os.makedirs(rsampath)
 
-t = tr.stats.starttime
-index = 0
-#loop through data in 600sec (10 min) blocks
-while t < tr.stats.endtime:
-  tr_10m = tr.slice(t, t + 600)
-
-  duration = tr_10m.stats.npts * tr_10m.stats.delta
-  #print index, duration
-  if duration >= 500:
-    if duration < 600:
-      tr_10m = tr.slice(tr.stats.endtime - 600, tr.stats.endtime) 
-    #detrend and filter
-    tr_10m.detrend(type='constant')
-    if filtype == 'lp':
-      #print 'lowpass'
-      tr_10m.filter('lowpass', freq=f, corners=4, zerophase=False)
-    elif filtype == 'hp':
-      #print 'highpass'
-      tr_10m.filter('highpass', freq=f, corners=4, zerophase=False)
-    elif filtype == 'bp':
-      #print 'bandpass'
-      tr_10m.filter('bandpass', freqmin=f1, freqmax=f2, corners=4, zerophase=False)
-
-    absolute = np.absolute(tr_10m.data)	#absolute value
-    tr_10m.data = absolute	#assign back to trace
-    mean = tr_10m.data.mean()
-    if resp == 'resp':
-      mean = mean / 1e-9	#convert to nanometres so dealing with whole numbers
-    data[index] = mean
-    index += 1
-    #end if 
-  t += 600
-#end loop through data in 600sec (10 min) blocks
-
-#resize data to remove any unused elements
-data = np.resize(data, index)
+#rsam values from 600sec (10 min) blocks of the data
+if filtype == 'lp':
+  sos = design_filter('lowpass', tr.stats.sampling_rate, freq=f)
+elif filtype == 'hp':
+  sos = design_filter('highpass', tr.stats.sampling_rate, freq=f)
+elif filtype == 'bp':
+  sos = design_filter('bandpass', tr.stats.sampling_rate, freqmin=f1, freqmax=f2)
+else:
+  sos = None
+data = trace_rsam(tr, sos)
+if resp == 'resp':
+  data = data / 1e-9	#convert to nanometres so dealing with whole numbers
 
 #write mseed format file
 #mseed header attributes
@@ -149,3 +113,4 @@ stats = {'network': network, 'station': station, 'location': location,
          'mseed': {'dataquality': 'D'}, 'starttime': starttime}
 st = Stream([Trace(data=data, header=stats)])
 st.write(rsamfile, format='MSEED', reclen=256)
+update_day_index(rsamfile, st[0])	#daily summary for the year file
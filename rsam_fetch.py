@@ -0,0 +1,577 @@
+#!/usr/bin/env python
+# rsam_fetch.py
+# waveform fetching from FDSN web services shared by the rsam scripts
+
+# past days are kept in a local SDS layout cache
+# (<root>/YYYY/NET/STA/CHA.D/NET.STA.LOC.CHA.D.YYYY.JJJ) and treated as
+# immutable; the current, incomplete day is always fetched again
+
+# several requests can be fetched at once with fetch_concurrently; the
+# number of requests in flight to any one web server is limited by
+# MAX_PER_HOST
+
+# one Client is created per service and reused by every request of the
+# process, so service discovery is only done once; client_timings reports
+# the time spent creating clients and in requests
+
+# data missing from one service are requested from the next service only for
+# the missing time spans and spliced in, keeping the earlier service's data
+# where the two overlap
+
+# instrument sensitivities are kept per NSLC and channel epoch in a local
+# JSON file by SensitivityCache, so response removal needs no station
+# service request while the cached epoch is younger than its TTL
+
+# RESP files are downloaded once into a local directory by fetch_resp and
+# refreshed after DEFAULT_SENSITIVITY_TTL
+
+# fetch_chunks fetches a time span in consecutive chunks, so long spans can
+# be processed without holding all of their data
+
+# fetch_bulk combines many requests into one FDSN bulk request per web
+# server, splitting the returned data back out by NSLC and time span
+
+import json
+import os
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from obspy.core import read, Stream, UTCDateTime
+from obspy.clients.fdsn import Client
+try:
+    from urllib.parse import urlparse
+    from urllib.request import urlretrieve
+except ImportError:  # python 2
+    from urlparse import urlparse
+    from urllib import urlretrieve
+
+# GeoNet's FDSN web servers
+NRT_SERVICE = 'https://service-nrt.geonet.org.nz'
+ARCHIVE_SERVICE = 'https://service.geonet.org.nz'
+
+SERVICES = {'NZ': [NRT_SERVICE, ARCHIVE_SERVICE],  # near real time first, then archive
+            'IU': ['IRIS']}
+
+MAX_GAP = 60  # largest gap (s) in data from one service before it is requested from the next
+COMPLETE_AFTER = 3600  # time (s) after the end of a day before it is treated as complete
+DEFAULT_CACHE_BYTES = 20 * 1024 ** 3  # 20 GB
+DEFAULT_SENSITIVITY_TTL = 7 * 86400  # time (s) before a cached sensitivity is requested again
+MAX_WORKERS = 8  # default number of requests fetched at once
+MAX_PER_HOST = 4  # largest number of requests in flight to one web server
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+_clients = {}
+_clients_lock = threading.Lock()
+_timings = {}  # per service [client setup time (s), number of requests, request time (s)]
+
+
+def host_slot(service):
+    """
+    Return the semaphore limiting concurrent requests to a service's host.
+    """
+    host = urlparse(service).netloc or service  # short names like 'IRIS' have no netloc
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(MAX_PER_HOST)
+        return _host_slots[host]
+
+
+def get_client(service):
+    """
+    Return the shared Client of a service, creating it on first use.
+
+    The Client is built outside the lock, as it requests the service's
+    WADL documents, so requests to other services are not held up; if two
+    threads build one for the same service at once the first stored is kept.
+    """
+    with _clients_lock:
+        if service in _clients:
+            return _clients[service]
+    t0 = time.time()
+    client = Client(service)
+    setup_time = time.time() - t0
+    with _clients_lock:
+        if service not in _clients:
+            _clients[service] = client
+            _timings[service] = [setup_time, 0, 0.]
+        return _clients[service]
+
+
+def timed_request(service, method, *args, **kwargs):
+    """
+    Call method of the shared Client of a service, recording its duration.
+    """
+    client = get_client(service)
+    t0 = time.time()
+    try:
+        return getattr(client, method)(*args, **kwargs)
+    finally:
+        elapsed = time.time() - t0
+        with _clients_lock:
+            _timings[service][1] += 1
+            _timings[service][2] += elapsed
+
+
+def client_timings():
+    """
+    Return {service: (setup time, number of requests, request time)} for the clients used so far.
+    """
+    with _clients_lock:
+        return dict((service, tuple(timing)) for service, timing in _timings.items())
+
+
+class WaveformCache(object):
+    """
+    Size-bounded SDS layout cache of day-long waveform files.
+
+    Only complete past days are stored. When the cache grows beyond
+    max_bytes the least recently used day files are removed. The cached
+    files are listed once, on the first store, and then tracked as they
+    are stored, used and removed.
+    """
+
+    def __init__(self, root, max_bytes=DEFAULT_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.files = None  # {path: (last use, size)} of the cached files, once listed
+        self.total = 0  # bytes of the listed files
+        self.lock = threading.Lock()
+
+    def path(self, network, station, location, channel, day):
+        day = UTCDateTime(day)
+        name = '.'.join((network, station, location, channel, 'D', day.strftime('%Y.%j')))
+        return os.path.join(self.root, day.strftime('%Y'), network, station, channel + '.D', name)
+
+    def get(self, network, station, location, channel, day):
+        """
+        Return the cached Stream for a day, or None if it is not cached.
+        """
+        path = self.path(network, station, location, channel, day)
+        try:
+            os.utime(path, None)  # mark as recently used
+            st = read(path)
+        except (IOError, OSError):  # not cached, or removed by a concurrent fetch
+            return None
+        with self.lock:
+            if self.files is not None and path in self.files:
+                self.files[path] = (time.time(), self.files[path][1])
+        return st
+
+    def put(self, st, network, station, location, channel, day, now=None):
+        """
+        Store a day's Stream if the day is complete. Returns True if stored.
+        """
+        now = UTCDateTime() if now is None else UTCDateTime(now)
+        if UTCDateTime(day) + 86400 + COMPLETE_AFTER > now or len(st) == 0:
+            return False
+        path = self.path(network, station, location, channel, day)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:  # already made, possibly by a concurrent fetch
+            pass
+        st.write(path + '.tmp', format='MSEED')
+        os.rename(path + '.tmp', path)  # so readers never see a partial file
+        with self.lock:
+            if self.files is None:
+                self.scan()
+            else:
+                self.total -= self.files.get(path, (0, 0))[1]
+                self.files[path] = (time.time(), os.path.getsize(path))
+                self.total += self.files[path][1]
+            self.evict()
+        return True
+
+    def scan(self):
+        """
+        List the cached files, leaving out those still being written.
+        """
+        self.files = {}
+        self.total = 0
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith('.tmp'):  # being written by a concurrent fetch
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # removed by a concurrent fetch
+                    continue
+                self.files[path] = (stat.st_mtime, stat.st_size)
+                self.total += stat.st_size
+
+    def evict(self):
+        """
+        Remove least recently used files until the cache fits in max_bytes. Called holding the lock, once listed.
+        """
+        if self.total <= self.max_bytes:
+            return
+        for path in sorted(self.files, key=lambda path: self.files[path][0]):
+            if self.total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:  # already removed by a concurrent fetch
+                pass
+            self.total -= self.files.pop(path)[1]
+
+
+def epoch_covers(epoch, time):
+    """Return whether a cached sensitivity epoch covers a time."""
+    return UTCDateTime(epoch['start']) <= time and (epoch['end'] is None or time < UTCDateTime(epoch['end']))
+
+
+class SensitivityCache(object):
+    """
+    Persistent cache of overall instrument sensitivities by NSLC and channel epoch.
+
+    A sensitivity is requested from the station service when no cached
+    epoch covers the data, or when the covering epoch was fetched more than
+    ttl seconds ago, so changed metadata are picked up. If that request
+    fails, an expired covering epoch is used, with a warning.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_SENSITIVITY_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.epochs = {}  # lists of {'start', 'end', 'sensitivity', 'fetched'} keyed by NSLC
+        self.lock = threading.RLock()
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.epochs = json.load(f)
+
+    def save(self):
+        """
+        Write the cache through a temporary file of its own, so processes sharing the cache can save at once.
+        """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:  # already made by a concurrent process
+                pass
+        fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix=os.path.basename(self.path) + '.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.epochs, f)
+        os.chmod(tmp_path, 0o644)  # mkstemp makes the file private
+        os.replace(tmp_path, self.path)
+
+    def get(self, network, station, location, channel, time, services=None, now=None):
+        """
+        Return the overall sensitivity of a stream at a time.
+        """
+        with self.lock:
+            time = UTCDateTime(time)
+            now = UTCDateTime() if now is None else UTCDateTime(now)
+            nslc = '.'.join((network, station, location, channel))
+            covering = [epoch for epoch in self.epochs.get(nslc, []) if epoch_covers(epoch, time)]
+            for epoch in covering:
+                if now - UTCDateTime(epoch['fetched']) <= self.ttl:
+                    return epoch['sensitivity']
+
+            if services is None:
+                if network not in SERVICES:
+                    raise Exception("Don't know how to request data for network {:s}".format(network))
+                services = SERVICES[network]
+            try:
+                with host_slot(services[-1]):
+                    inventory = timed_request(services[-1], 'get_stations', network=network, station=station,
+                                              location=location, channel=channel, starttime=time, endtime=time + 1,
+                                              level='response')
+            except Exception as e:
+                if not covering:
+                    raise
+                print('Station request for {:s} at {:s} failed ({:s}), using the sensitivity fetched at {:s}'.format(
+                    nslc, str(time), str(e), covering[-1]['fetched']))
+                return covering[-1]['sensitivity']
+            epochs = [epoch for epoch in self.epochs.get(nslc, []) if not epoch_covers(epoch, time)]
+            channels = [cha for net in inventory.select(network=network, station=station, location=location,
+                                                        channel=channel, time=time)
+                        for sta in net for cha in sta]
+            if not channels:
+                raise Exception('No station metadata for {:s} at {:s}'.format(nslc, str(time)))
+            sensitivity = None
+            for cha in channels:
+                if cha.response is None or cha.response.instrument_sensitivity is None or \
+                        cha.response.instrument_sensitivity.value is None:
+                    raise Exception('No instrument sensitivity for {:s} at {:s}'.format(nslc, str(time)))
+                sensitivity = cha.response.instrument_sensitivity.value
+                epochs.append({'start': str(cha.start_date),
+                               'end': str(cha.end_date) if cha.end_date is not None else None,
+                               'sensitivity': sensitivity,
+                               'fetched': str(now)})
+            self.epochs[nslc] = epochs
+            self.save()
+            return sensitivity
+
+    def remove_sensitivity(self, st, services=None):
+        """
+        Divide each trace of st by its cached sensitivity, as Stream.remove_sensitivity does.
+        """
+        for tr in st:
+            sensitivity = self.get(tr.stats.network, tr.stats.station, tr.stats.location, tr.stats.channel,
+                                   tr.stats.starttime, services)
+            tr.data = tr.data / sensitivity
+        return st
+
+
+def fetch_resp(url, directory, max_age=DEFAULT_SENSITIVITY_TTL, now=None):
+    """
+    Return the path of a local copy of a RESP file, downloading it if missing or older than max_age seconds.
+    """
+    path = os.path.join(directory, os.path.basename(urlparse(url).path))
+    now = UTCDateTime() if now is None else UTCDateTime(now)
+    if not os.path.isfile(path) or now.timestamp - os.path.getmtime(path) > max_age:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        urlretrieve(url, path + '.tmp')
+        os.rename(path + '.tmp', path)
+    return path
+
+
+def missing_spans(st, starttime, endtime, max_gap=MAX_GAP):
+    """
+    Return a list of (t1, t2) spans longer than max_gap between two times without data in st.
+
+    If st has data, spans within COMPLETE_AFTER of now are ignored, as their
+    data may still be arriving at the services.
+    """
+    if len(st) == 0:
+        return [(UTCDateTime(starttime), UTCDateTime(endtime))]
+    endtime = min(UTCDateTime(endtime), UTCDateTime() - COMPLETE_AFTER)
+    spans = []
+    t = UTCDateTime(starttime)
+    for tr in sorted(st, key=lambda tr: tr.stats.starttime):
+        if tr.stats.starttime - t > max_gap:
+            spans.append((t, tr.stats.starttime))
+        t = max(t, tr.stats.endtime)
+    if endtime - t > max_gap:
+        spans.append((t, endtime))
+    return spans
+
+
+def splice(st, fill, spans):
+    """
+    Add the data of fill within spans to st, keeping st's samples at the span edges.
+    """
+    edges = [tr.stats.starttime for tr in st] + [tr.stats.endtime for tr in st]
+    for t1, t2 in spans:
+        for tr in fill:
+            margin = tr.stats.delta / 2
+            tr = tr.slice(t1 + margin if t1 in edges else t1 - margin,
+                          t2 - margin if t2 in edges else t2 + margin,
+                          nearest_sample=False)
+            if tr.stats.npts > 0:
+                st.append(tr)
+    st.sort(['starttime'])
+    return st
+
+
+def fill_gaps(st, network, station, location, channel, starttime, endtime, attach_response, services):
+    """
+    Return st with the spans missing from it requested from each service in turn and spliced in.
+    """
+    for service in services:
+        spans = missing_spans(st, starttime, endtime)
+        if not spans:
+            break
+        fill = Stream()
+        for t1, t2 in spans:
+            try:
+                with host_slot(service):
+                    fill += timed_request(service, 'get_waveforms', network, station, location, channel, t1, t2,
+                                          attach_response=attach_response)
+            except Exception:
+                continue
+        splice(st, fill, spans)
+    return st
+
+
+def fetch_waveforms(network, station, location, channel, starttime, endtime, attach_response=False, services=None):
+    """
+    Return a Stream of data between two times for a stream, or None if there is none.
+
+    Services are tried in order (by default the GeoNet near real time then
+    archive services for NZ, IRIS for IU). Each later service is only asked
+    for the spans longer than MAX_GAP still missing, which are spliced into
+    the data already fetched.
+    """
+    starttime = UTCDateTime(starttime)
+    endtime = UTCDateTime(endtime)
+    if services is None:
+        if network not in SERVICES:
+            raise Exception("Don't know how to request data for network {:s}".format(network))
+        services = SERVICES[network]
+
+    st = fill_gaps(Stream(), network, station, location, channel, starttime, endtime, attach_response, services)
+    if len(st) == 0:
+        return None
+    return st
+
+
+def fetch_chunks(network, station, location, channel, starttime, endtime, chunk=3600, attach_response=False,
+                 services=None):
+    """
+    Yield Streams of data for consecutive chunk second spans between two times.
+
+    Each span is fetched with fetch_waveforms when the previous one has been
+    consumed; spans without data are skipped.
+    """
+    t = UTCDateTime(starttime)
+    endtime = UTCDateTime(endtime)
+    while t < endtime:
+        st = fetch_waveforms(network, station, location, channel, t, min(t + chunk, endtime), attach_response,
+                             services)
+        if st is not None:
+            yield st
+        t += chunk
+
+
+def fetch_bulk(requests, attach_response=False, services=None, workers=MAX_WORKERS):
+    """
+    Return a list with a Stream, or None, for each (network, station, location, channel, starttime, endtime) request.
+
+    Requests are sent in one bulk request to the first service of their
+    network (or of services). Spans longer than MAX_GAP missing from the
+    bulk response are requested from the later services with fill_gaps,
+    and requests the bulk request fails for are fetched again one at a time
+    with fetch_waveforms, up to workers at once.
+    """
+    requests = [(network, station, location, channel, UTCDateTime(starttime), UTCDateTime(endtime))
+                for network, station, location, channel, starttime, endtime in requests]
+    groups = {}  # request indices keyed by the services used for them
+    for n, request in enumerate(requests):
+        if services is not None:
+            request_services = services
+        elif request[0] in SERVICES:
+            request_services = SERVICES[request[0]]
+        else:
+            raise Exception("Don't know how to request data for network {:s}".format(request[0]))
+        groups.setdefault(tuple(request_services), []).append(n)
+
+    results = [None] * len(requests)
+    retry = []  # (request index, bulk response for it, services to fetch the rest of its data from)
+    for group_services, indices in groups.items():
+        try:
+            with host_slot(group_services[0]):
+                st = timed_request(group_services[0], 'get_waveforms_bulk', [requests[n] for n in indices],
+                                   attach_response=attach_response)
+        except Exception:
+            retry.extend((n, Stream(), group_services) for n in indices)
+            continue
+        for n in indices:
+            network, station, location, channel, starttime, endtime = requests[n]
+            request_st = st.select(network=network, station=station, location=location, channel=channel)
+            request_st = request_st.slice(starttime, endtime)
+            if len(request_st) == 0:
+                retry.append((n, request_st, group_services))
+            elif len(group_services) > 1 and missing_spans(request_st, starttime, endtime):
+                retry.append((n, request_st, group_services[1:]))
+            else:
+                results[n] = request_st
+
+    def fetch_rest(retry_request):
+        n, st, rest_services = retry_request
+        st = fill_gaps(st, *requests[n], attach_response=attach_response, services=rest_services)
+        return st if len(st) > 0 else None
+
+    for (n, _, _), st in fetch_concurrently(retry, fetch_rest, workers=workers):
+        results[n] = st
+    return results
+
+
+def fetch_day(network, station, location, channel, day, cache=None, attach_response=False, services=None,
+              prefetched=None):
+    """
+    Return a Stream with one day of data for a stream, or None if there is none.
+
+    Data are fetched with fetch_waveforms, unless the day's data are given
+    as prefetched (e.g. from fetch_bulk). Complete past days are served
+    from and stored in cache when one is given.
+    """
+    start = UTCDateTime(day)
+    end = start + 86400
+    if services is None:
+        if network not in SERVICES:
+            raise Exception("Don't know how to request data for network {:s}".format(network))
+        services = SERVICES[network]
+
+    if cache is not None:
+        st = cache.get(network, station, location, channel, start)
+        if st is not None:
+            if attach_response:
+                with host_slot(services[-1]):
+                    inventory = timed_request(services[-1], 'get_stations', network=network, station=station,
+                                              location=location, channel=channel, starttime=start, endtime=end,
+                                              level='response')
+                st.attach_response(inventory)
+            return st
+
+    if prefetched is not None:
+        st = prefetched
+    else:
+        st = fetch_waveforms(network, station, location, channel, start, end, attach_response, services)
+    if st is not None and cache is not None:
+        cache.put(st, network, station, location, channel, start)
+    return st
+
+
+def fetch_since(network, station, location, channel, day, since, cache=None, attach_response=False, warmup=0,
+                services=None, prefetched=None):
+    """
+    Return (st, joined) for the data of a day from since onwards.
+
+    Data from since - warmup to the end of the day are fetched with
+    fetch_waveforms; joined is True if they start by since. Otherwise, or
+    if since is None, the whole day is fetched with fetch_day and joined is
+    False. Data already fetched for the same span can be given as
+    prefetched.
+    """
+    end = UTCDateTime(day) + 86400
+    if since is not None:
+        since = UTCDateTime(since)
+        if prefetched is not None:
+            st = prefetched
+        else:
+            st = fetch_waveforms(network, station, location, channel, since - warmup, end, attach_response, services)
+        if st is not None and min(tr.stats.starttime for tr in st) <= since + st[0].stats.delta / 2:
+            return st, True
+        prefetched = None
+    return fetch_day(network, station, location, channel, day, cache, attach_response, services, prefetched), False
+
+
+def fetch_concurrently(requests, fetch, workers=MAX_WORKERS, ordered=False):
+    """
+    Yield (request, fetch(request)) for each request, fetching up to workers at once.
+
+    Results are yielded as the fetches complete, or in the order of requests
+    if ordered is True, so they can be processed while later requests are
+    still being fetched. Requests to each web server are further limited to
+    MAX_PER_HOST at once. A request is only submitted once fewer than
+    workers results are being fetched or waiting to be taken, so fetched data
+    does not pile up when processing is slower than fetching.
+    """
+    pool = ThreadPool(max(1, workers))
+    slots = threading.Semaphore(max(1, workers))
+    stopped = threading.Event()
+
+    def submitted():
+        for request in requests:
+            slots.acquire()
+            if stopped.is_set():
+                return
+            yield request
+
+    try:
+        if ordered:
+            results = pool.imap(lambda request: (request, fetch(request)), submitted())
+        else:
+            results = pool.imap_unordered(lambda request: (request, fetch(request)), submitted())
+        for result in results:
+            slots.release()
+            yield result
+    finally:
+        stopped.set()
+        slots.release()  # wake the task handler if it is waiting to submit
+        pool.terminate()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""
+Derive spectral RSAM timeseries for any frequency range from the per-window spectra stored by
+rsamtools.py --store-spectra, without fetching or processing waveforms again.
+
+Writes the same YYYY.JJJ.<stream>.<band>.spectral.rsam day files as rsamtools.py --spectral.
+"""
+
+import argparse
+import datetime
+from obspy.core import Trace, Stream, UTCDateTime
+import os
+from rsam_engine import binned_band_rsam, load_spectra
+from rsam_store import update_day_index
+
+
+# Parse arguments from command line
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--streams',
+                    type=str,
+                    help='Streams(s) to derive RSAM data for. Format is a comma-separated list of '
+                         'NETWORK.SITE.LOC.CHANNEL strings, e.g. NZ.WIZ.10.HHZ,NZ.WSRZ.10.HHZ')
+parser.add_argument('--start-date',
+                    type=str,
+                    help='First date to derive RSAM for. Format is YYYYMMDD in UTC.')
+parser.add_argument('--end-date',
+                    type=str,
+                    help='Last date to derive RSAM for. Format is YYYYMMDD in UTC.')
+parser.add_argument('--response',
+                    action='store_true',
+                    help='Whether the spectra were stored from data with the instrument response removed.')
+parser.add_argument('--filter-ranges',
+                    type=str,
+                    help='Frequency range to derive RSAM for, set either bound to None to apply no limit on '
+                         'that bound. Give a comma-separated list of frequency bounds to produce multiple RSAM '
+                         'timeseries, e.g. [0,5],[5,10]')
+args = parser.parse_args()
+
+streams = args.streams.split(',')
+start_date = datetime.datetime.strptime(args.start_date, '%Y%m%d')
+end_date = datetime.datetime.strptime(args.end_date, '%Y%m%d')
+
+for n in range((end_date - start_date).days + 1):
+
+    start = UTCDateTime(start_date) + 86400 * n
+
+    for stream in streams:
+
+        # Read stored spectra for the day
+
+        rsam_data_path = './rsam_files/' + stream
+        spectra_file_path = rsam_data_path + '/' + start.strftime("%Y.%j") + '.' + stream + '.spectra.npz'
+        if not os.path.isfile(spectra_file_path):
+            print("Can't find file %s" % spectra_file_path)
+            continue
+        starttime, sampling_rate, edges, power = load_spectra(spectra_file_path)
+        network, station, location, channel = stream.split('.')
+
+        frequency_ranges = args.filter_ranges.split('],[')
+        for frequency_range in frequency_ranges:
+            frequency_bounds = frequency_range.replace('[', '').replace(']', '').split(',')
+
+            print('Deriving 10-minute spectral RSAM values for ' + stream + ' on date ' + str(start)[:10] +
+                  ' between frequency bounds ' + frequency_bounds[0] + '-' + frequency_bounds[1] + ' Hz')
+
+            # Define RSAM file name and band
+
+            if not frequency_bounds[0] and not frequency_bounds[1]:
+                band = (None, None, None, None)
+                file_name = start.strftime("%Y.%j") + '.' + stream + '.spectral.rsam'
+            elif frequency_bounds[0] and not frequency_bounds[1]:
+                lower_bound = '%.2f' % float(frequency_bounds[0])  # String of lower frequency bound to 2 decimal places
+                band = ('lowpass', float(lower_bound), None, None)
+                file_name = start.strftime("%Y.%j") + '.' + stream + '.low_pass_' + lower_bound + '.spectral.rsam'
+            elif frequency_bounds[1] and not frequency_bounds[0]:
+                upper_bound = '%.2f' % float(frequency_bounds[1])  # String of upper frequency bound to 2 decimal places
+                band = ('highpass', float(upper_bound), None, None)
+                file_name = start.strftime("%Y.%j") + '.' + stream + '.high_pass_' + upper_bound + '.spectral.rsam'
+            elif frequency_bounds[0] and frequency_bounds[1]:
+                lower_bound = '%.2f' % float(frequency_bounds[0])  # String of lower frequency bound to 2 decimal places
+                upper_bound = '%.2f' % float(frequency_bounds[1])  # String of upper frequency bound to 2 decimal places
+                band = ('bandpass', None, float(lower_bound), float(upper_bound))
+                file_name = start.strftime("%Y.%j") + '.' + stream + '.band_pass_' + lower_bound + '-' + upper_bound + \
+                            '.spectral.rsam'
+
+            # Derive RSAM values from the spectra
+
+            data = binned_band_rsam(edges, power, band, sampling_rate)
+            if args.response:
+                data = data / 1e-9  # Convert data to nanometres so dealing with whole numbers
+
+            # Write RSAM file in miniSEED format
+
+            delta = 600  # 10 min windows between RSAM values
+            stats = {'network': network,
+                     'station': station,
+                     'location': location,
+                     'channel': channel,
+                     'npts': len(data),
+                     'delta': delta,
+                     'mseed': {'dataquality': 'D'},
+                     'starttime': starttime}
+            out_st = Stream([Trace(data=data,
+                                   header=stats)])
+            out_st.write(rsam_data_path + '/' + file_name,
+                         format='MSEED',
+                         reclen=256)
+            update_day_index(rsam_data_path + '/' + file_name, out_st[0])
@@ -9,20 +9,27 @@ import matplotlib.pyplot as plt
 import datetime as dt
 import math
 from matplotlib.dates import date2num
-from matplotlib.dates import num2date
-import matplotlib.dates as mdates
-import matplotlib.ticker as mticker
-from obspy.core import read, Trace, Stream
 import sys
 import os
-import numpy as np
-import scipy as sp
 import pytz
+from rsam_reader import RSAMReader
+import rsam_reader
+import rsam_render
+import rsam_store
+from rsam_render import minmax_envelope, plot_columns, plot_pixels, plot_ymax, PlotCache, PLOT_AXES, PLOT_SIZE, \
+    threshold_zones, write_plot_payload
+
+# output formats, any of png, svg and json (the payload drawn by rsam_viewer.html)
+formats = ['png', 'svg']
+for arg in list(sys.argv[1:]):
+    if arg.startswith('--formats='):
+        formats = arg[len('--formats='):].split(',')
+        sys.argv.remove(arg)
 
 # start here
-if (len(sys.argv) < 8) | (len(sys.argv) > 10):
+if (len(sys.argv) < 8) | (len(sys.argv) > 10) | (len(set(formats) - {'png', 'svg', 'json'}) > 0):
     sys.exit(
-        "syntax rsam_plot.py site(DRZ.10-EHZ.CH) rsam_dir date1(yyyymmdd) date2(yyyymmdd) plot_dir basetriglev filter(lp,hp,bp,none) [f1 f2]")
+        "syntax rsam_plot.py site(DRZ.10-EHZ.CH) rsam_dir date1(yyyymmdd) date2(yyyymmdd) plot_dir basetriglev filter(lp,hp,bp,none) [f1 f2] [--formats=png,svg,json]")
 else:
     site = sys.argv[1]
     rsam_dir = sys.argv[2]
@@ -46,39 +53,45 @@ site_dir = str.split(site, '.')[0] + '.' + str.split(site, '.')[2]
 
 # format dates as datetime variables
 d1 = dt.datetime.strptime(date1, '%Y%m%d')
-yd1 = date2num(d1)
 d2 = dt.datetime.strptime(date2, '%Y%m%d')
-yd2 = date2num(d2)
-yd2 = yd2 + 1  # so date range is inclusive
-dates = num2date(np.arange(yd1, yd2, 1))
-
-st = Stream()  # create empty stream
-for date in dates:
-    # get rsam file name
-    yd = date.strftime("%Y.%j")
-    if filtype == 'none':
-        rsamfile = os.path.join(rsam_dir, site_dir, yd + '.' + site + '.rsam')
-    elif (filtype == 'lp') | (filtype == 'hp'):
-        strf = '%.2f' % f  # string version with 2 decimal places
-        rsamfile = os.path.join(
-            rsam_dir, site_dir, yd + '.' + site + '.' + filtype + '_' + strf + '.rsam')
-    elif filtype == 'bp':
-        strf1 = '%.2f' % f1  # string version with 2 decimal places
-        strf2 = '%.2f' % f2  # string version with 2 decimal places
-        rsamfile = os.path.join(
-            rsam_dir, site_dir, yd + '.' + site + '.' + filtype + '_' + strf1 + '-' + strf2 + '.rsam')
-
-    # process rsamfile
-    if os.path.isfile(rsamfile):
-        st += read(rsamfile)
-
-# merge to single stream
-st.merge(fill_value='interpolate')
-tr = st[0]
+d2 = d2 + dt.timedelta(days=1)  # so date range is inclusive
+
+# band part of rsam file names
+if filtype == 'none':
+    band = ''
+elif (filtype == 'lp') | (filtype == 'hp'):
+    strf = '%.2f' % f  # string version with 2 decimal places
+    band = filtype + '_' + strf
+elif filtype == 'bp':
+    strf1 = '%.2f' % f1  # string version with 2 decimal places
+    strf2 = '%.2f' % f2  # string version with 2 decimal places
+    band = filtype + '_' + strf1 + '-' + strf2
+
+# read 10 min rsam values of the date range from the day files
+reader = RSAMReader(rsam_dir, stream_dir=lambda site: site_dir)
+val_file = '/home/samto/PROCESSING/WIR/calendar_VAB.csv'
+
+# reuse the last rendered plot if its arguments, rsam files, VAL calendar and
+# plotting code are all unchanged since then
+plot_cache = PlotCache(os.path.join(plot_dir, 'plot_cache'))
+plot_parameters = {'script': os.path.basename(sys.argv[0]), 'arguments': sys.argv[1:], 'formats': formats}
+plot_outputs = [plot_file + '.' + plot_format for plot_format in formats]
+plot_fingerprint = plot_cache.fingerprint(plot_parameters,
+                                          reader.paths(site, band, d1, d2, pixels=plot_pixels()) +
+                                          [val_file, os.path.abspath(sys.argv[0]), rsam_render.__file__,
+                                           rsam_reader.__file__, rsam_store.__file__])
+if plot_cache.fetch(plot_parameters, plot_fingerprint, plot_outputs):
+    print('inputs unchanged, reusing %s' % plot_file)
+    sys.exit(0)
+
+# read the rsam values, from the coarsest rsam pyramid level resolving the plot if there is one
+times, data = reader.read(site, band, d1, d2, pixels=plot_pixels())
+starttime = times[0].astype(dt.datetime)
+endtime = times[-1].astype(dt.datetime)
 
 # parse VAL data
 val_changes, val_level_at_change = [], []
-with open('/home/samto/PROCESSING/WIR/calendar_VAB.csv', 'r') as openfile:
+with open(val_file, 'r') as openfile:
     rc = 0
     for row in openfile:
         if rc == 0:
@@ -89,34 +102,28 @@ with open('/home/samto/PROCESSING/WIR/calendar_VAB.csv', 'r') as openfile:
                                                       '%Y-%b-%d'))
         val_level_at_change.append(cols[2][:-1])
 
-# plot
-start = date2num(tr.stats.starttime.datetime)  # as decimal years
-end = date2num(tr.stats.endtime.datetime)
-
-
 # build plot ticks
-plot_range = (tr.stats.endtime.datetime - tr.stats.starttime.datetime).total_seconds() / 86400
+plot_range = (endtime - starttime).total_seconds() / 86400
 tick_range = math.ceil(plot_range)
-second_offset = 86400 - (tr.stats.starttime.datetime.hour * 3600 +
-                         tr.stats.starttime.datetime.minute * 60 +
-                         tr.stats.starttime.datetime.second +
-                         tr.stats.starttime.datetime.microsecond / 1000000)
+second_offset = 86400 - (starttime.hour * 3600 +
+                         starttime.minute * 60 +
+                         starttime.second +
+                         starttime.microsecond / 1000000)
 xticks = []
 xtick_labels = []
 for n in range(tick_range):
-    xticks.append((tr.stats.starttime.datetime + dt.timedelta(seconds=second_offset) + dt.timedelta(days=n)).astimezone(pytz.timezone('Pacific/Auckland')).date())
+    xticks.append((starttime + dt.timedelta(seconds=second_offset) + dt.timedelta(days=n)).astimezone(pytz.timezone('Pacific/Auckland')).date())
     if n % 2 == 0:
         xtick_labels.append(str(xticks[-1]))
     else:
         xtick_labels.append('')
 
 # add end time of data to val change calendar for plotting clarity
-val_changes.append(tr.stats.endtime.datetime)
+val_changes.append(endtime)
 val_level_at_change.append(val_level_at_change[-1])
 
 # time values
-#t = np.arange(start, end, tr.stats.delta/86400)
-t = sp.linspace(start, end, tr.stats.npts)
+t = date2num(times)
 
 # plot
 #date and time
@@ -138,29 +145,45 @@ elif filtype == 'bp':
     title = 'RSAM: ' + site + ', date: ' + date1 + '-' + date2 + ' UT, filter: ' + filtype + \
         ' ' + strf1 + ' - ' + strf2 + ' Hz' + \
             ', plotted at: ' + now.strftime("%Y-%m-%d %H:%M") + ', BTL = ' + basetrig
-fig = plt.figure(figsize=(15, 5))
-plt.axes([0.1, 0.2, 0.85, 0.7])
+plot_title = 'Real-Time Seismic Amplitude (RSAM: a measure of seismic energy) at Whakaari/White Island in the last month'
+eruption_dt = dt.datetime.strptime('2019-12-09T01:11:47Z',
+                                   '%Y-%m-%dT%H:%M:%SZ')
 
-maxy = 1.1 * tr.data.max()
+# write the series, threshold zones, VAL changes and eruption for drawing in a browser
+if 'json' in formats:
+    write_plot_payload({'title': plot_title,
+                        'base_trig': basetrig,
+                        'series': [(times, data, 'RSAM', '-')],
+                        'events': [(val_changes[n], 'VAL ' + val_level_at_change[n]) for n in range(len(val_changes) - 1)],
+                        'spans': [(eruption_dt - dt.timedelta(hours=6), eruption_dt + dt.timedelta(hours=6), 'red',
+                                   'Eruption')]},
+                       plot_file + '.json')
+if 'png' not in formats and 'svg' not in formats:
+    plot_cache.store(plot_parameters, plot_fingerprint, plot_outputs)
+    sys.exit(0)
+
+fig = plt.figure(figsize=PLOT_SIZE)
+plt.axes(PLOT_AXES)
+
+maxy = plot_ymax(data)
 plt.ylim(bottom=0, top=maxy)
 
 #base trigger level on plot, if in scale
 if basetrig != 'null':
-  bt = float(basetrig)
-  half = bt / 2
-  plt.axhline(y=bt, linestyle='--', color = 'red', label='RSAM alert value')
+  plt.axhline(y=float(basetrig), linestyle='--', color = 'red', label='RSAM alert value')
   #colour areas based on relation to BTL
-  plt.axhspan(0, half, alpha=0.1, color='green', label='Weak RSAM zone') #low rectangle
-  plt.axhspan(half, bt, alpha=0.1, color='orange', label='Moderate RSAM zone') #moderate rectangle
-  plt.axhspan(bt, 100000, alpha=0.1, color='red', label='Strong RSAM zone') #high rectangle
+  for bottom, top, colour, label in threshold_zones(basetrig):
+    plt.axhspan(bottom, top if top is not None else 100000, alpha=0.1, color=colour, label=label)
 
-plt.plot_date(t, tr.data, linewidth=1, linestyle='-', marker='None', color='black', label='RSAM')
+# draw the min/max envelope of each pixel column, keeping peaks visible
+env_times, env_data = minmax_envelope(times, data, plot_columns(fig, plt.gca()))
+plt.plot(env_times, env_data, linewidth=1, linestyle='-', marker='None', color='black', label='RSAM')
 
 # Plot VAL calendar
 plt.vlines(val_changes, 0, 999999, linestyles='dashed', color='black', label='VAL change')
 for n in range(len(val_changes) - 1):
     if int(val_level_at_change[n - 1]) < 3 and int(val_level_at_change[n]) == 4:  # Catch when an eruption occurs
-        plt.annotate(s='VAL ' + val_level_at_change[n],
+        plt.annotate(text='VAL ' + val_level_at_change[n],
                      xy=(val_changes[n],
                          maxy - maxy/11),
                      xytext=(val_changes[n] + dt.timedelta(hours=12),
@@ -172,7 +195,7 @@ for n in range(len(val_changes) - 1):
                                  'arrowstyle': '->',
                                  'relpos': (0, 0.5)})
     else:
-        plt.annotate(s='VAL ' + val_level_at_change[n],
+        plt.annotate(text='VAL ' + val_level_at_change[n],
                      xy=(val_changes[n],
                          maxy - maxy/11),
                      xytext=(val_changes[n] + dt.timedelta(seconds=(val_changes[n + 1] - val_changes[n]).total_seconds() / 2),
@@ -186,8 +209,6 @@ for n in range(len(val_changes) - 1):
 
 # Add eruption box
 
-eruption_dt = dt.datetime.strptime('2019-12-09T01:11:47Z',
-                                   '%Y-%m-%dT%H:%M:%SZ')
 rect = Rectangle(xy=(eruption_dt - dt.timedelta(hours=6), 0),
                  width=(dt.timedelta(hours=12)),
                  height=maxy + maxy/20,
@@ -207,7 +228,7 @@ plt.text(s='Eruption',
                    'color': 'red'})
 
 # plt.title(title)
-plt.title('Real-Time Seismic Amplitude (RSAM: a measure of seismic energy) at Whakaari/White Island in the last month',
+plt.title(plot_title,
           y=1.03,
           fontdict={'fontsize': 14})
 plt.yticks(plt.gca().get_yticks(),
@@ -227,6 +248,8 @@ plt.xlim(t[0], t[-1])
 
 plt.legend(loc='upper left')
 
-plt.savefig(plot_file + '.png', dpi=600, fmt='png')
-plt.savefig(plot_file + '.svg', dpi=600, fmt='svg')
+for plot_format in ('png', 'svg'):
+    if plot_format in formats:
+        plt.savefig(plot_file + '.' + plot_format, dpi=600, format=plot_format)
+plot_cache.store(plot_parameters, plot_fingerprint, plot_outputs)
 # plt.show()
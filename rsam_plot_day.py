@@ -9,13 +9,15 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import datetime as dt
 from matplotlib.dates import date2num
-from matplotlib.dates import num2date
-from obspy.core import read, Trace, Stream
 import sys
 import os
 import numpy as np
-from matplotlib.dates import YearLocator, MonthLocator, DayLocator, DateFormatter
-import scipy as sp
+from matplotlib.dates import MonthLocator
+from rsam_reader import RSAMReader, YEAR_RESOLUTION
+import rsam_reader
+import rsam_render
+import rsam_store
+from rsam_render import minmax_envelope, plot_columns, plot_ymax, PlotCache
 
 # start here
 if (len(sys.argv) < 7) | (len(sys.argv) > 9):
@@ -48,43 +50,44 @@ y1 = str(year1)
 y2 = str(year2ori)
 years = np.arange(year1,  year2, 1)
 
-st = Stream()  # create empty stream
-for year in years:
-    # get rsam file name
-    y = str(year)
-    if filtype == 'none':
-        rsamfile = os.path.join(rsam_dir, site_dir, y + '.' + site + '.rsam')
-    elif (filtype == 'lp') | (filtype == 'hp'):
-        strf = '%.2f' % f  # string version with 2 decimal places
-        rsamfile = os.path.join(
-            rsam_dir, site_dir, y + '.' + site + '.' + filtype + '_' + strf + '.rsam')
-    elif filtype == 'bp':
-        strf1 = '%.2f' % f1  # string version with 2 decimal places
-        strf2 = '%.2f' % f2  # string version with 2 decimal places
-        rsamfile = os.path.join(
-            rsam_dir, site_dir, y + '.' + site + '.' + filtype + '_' + strf1 + '-' + strf2 + '.rsam')
-
-    # process rsamfile
-    if os.path.isfile(rsamfile):
-        tr = read(rsamfile)[0]
-        tr.stats.delta = 86400.0
-        tr.stats.sampling_rate = 1./tr.stats.delta
-        st += tr
-
-# merge to single stream
-st.merge(fill_value='interpolate')
-tr = st[0]
-
-# plot
-start = date2num(tr.stats.starttime.datetime)  # as decimal years
-end = date2num(tr.stats.endtime.datetime)
+# band part of rsam file names
+if filtype == 'none':
+    band = ''
+elif (filtype == 'lp') | (filtype == 'hp'):
+    strf = '%.2f' % f  # string version with 2 decimal places
+    band = filtype + '_' + strf
+elif filtype == 'bp':
+    strf1 = '%.2f' % f1  # string version with 2 decimal places
+    strf2 = '%.2f' % f2  # string version with 2 decimal places
+    band = filtype + '_' + strf1 + '-' + strf2
+
+# read daily rsam values of the year range from the yearly files
+reader = RSAMReader(rsam_dir, stream_dir=lambda site: site_dir)
+val_file = '/home/samto/PROCESSING/WIR/calendar_VAB.csv'
+
+# reuse the last rendered plot if its arguments, rsam files, VAL calendar and
+# plotting code are all unchanged since then
+plot_cache = PlotCache(os.path.join(plot_dir, 'plot_cache'))
+plot_parameters = {'script': os.path.basename(sys.argv[0]), 'arguments': sys.argv[1:]}
+plot_fingerprint = plot_cache.fingerprint(plot_parameters,
+                                          reader.paths(site, band, dt.datetime(year1, 1, 1), dt.datetime(year2, 1, 1),
+                                                       resolution=YEAR_RESOLUTION) +
+                                          [val_file, os.path.abspath(sys.argv[0]), rsam_render.__file__,
+                                           rsam_reader.__file__, rsam_store.__file__])
+if plot_cache.fetch(plot_parameters, plot_fingerprint, [plot_file + '.png', plot_file + '.svg']):
+    print('inputs unchanged, reusing %s' % plot_file)
+    sys.exit(0)
+
+# read the rsam values
+times, data = reader.read(site, band, dt.datetime(year1, 1, 1), dt.datetime(year2, 1, 1),
+                          resolution=YEAR_RESOLUTION)
 
 # time values
-t = sp.linspace(start, end, tr.stats.npts)
+t = date2num(times)
 
 # parse VAL data
 val_changes, val_level_at_change = [], []
-with open('/home/samto/PROCESSING/WIR/calendar_VAB.csv', 'r') as openfile:
+with open(val_file, 'r') as openfile:
     rc = 0
     for row in openfile:
         if rc == 0:
@@ -99,9 +102,15 @@ with open('/home/samto/PROCESSING/WIR/calendar_VAB.csv', 'r') as openfile:
 #date and time
 now = dt.datetime.now()
 
-# final value and time
-lastval = str(int(tr.data[len(tr) - 1]))
-lasttim = tr.stats.endtime.strftime("%F")
+# final value and time, skipping days without a value
+valid = np.flatnonzero(np.isfinite(data))
+if len(valid):
+    lastval = str(int(data[valid[-1]]))
+    lasttim = times[valid[-1]].astype(dt.datetime).strftime("%F")
+elif len(times):
+    lastval, lasttim = 'none', times[-1].astype(dt.datetime).strftime("%F")
+else:
+    lastval, lasttim = 'none', y2
 
 if filtype == 'none':
     #title = 'RSAM: ' + site + ', date: ' + y1 + '-' + y2 + ' UT, filter: ' + filtype + ', plotted at: ' + now.strftime("%Y-%m-%d %H:%M")
@@ -125,10 +134,12 @@ minormonths = MonthLocator(interval=1)
 ax.xaxis.set_minor_locator(minormonths)
 ax.grid(True)
 
-maxy = 1.1 * tr.data.max()
+maxy = plot_ymax(data)
 plt.ylim(bottom=0, top=maxy)
 
-plt.plot_date(t, tr.data, linestyle='-', marker='None', color='red')
+# draw the min/max envelope of each pixel column, keeping peaks visible
+env_times, env_data = minmax_envelope(times, data, plot_columns(fig, ax))
+plt.plot(env_times, env_data, linestyle='-', marker='None', color='red')
 
 # Plot VAL calendar
 plt.vlines(val_changes, 0, 999999, linestyles='dashed', color='black')
@@ -139,6 +150,7 @@ plt.title(title)
 plt.ylabel('Ground Velocity (nm/s)')
 plt.xlim(t[0], t[-1])
 
-plt.savefig(plot_file + '.png', dpi=600, fmt='png')
-plt.savefig(plot_file + '.svg', dpi=600, fmt='svg')
+plt.savefig(plot_file + '.png', dpi=600, format='png')
+plt.savefig(plot_file + '.svg', dpi=600, format='svg')
+plot_cache.store(plot_parameters, plot_fingerprint, [plot_file + '.png', plot_file + '.svg'])
 # plt.show()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# rsam_reader.py
+# range queries of RSAM series by stream, band and time for the plotting scripts
+
+# a series is found through the file naming convention of the rsam scripts:
+# <rsam_dir>/<stream dir>/YYYY.JJJ.<stream>.<band><extension> day files of
+# 10 minute values, YYYY.<stream>.<band><extension> yearly files of daily
+# values, or for other resolutions the pyramid store files of rsam_store.py;
+# given the number of pixels a plot has for the series, a read uses the
+# coarsest pyramid level that still gives a value per pixel, falling back to
+# the day files where there is no pyramid covering the read
+
+# decoded files are kept in an in-process LRU cache bounded by the bytes of
+# their arrays, so overlapping queries in one run read each file only once;
+# a cached file is decoded again if its modification time or size changed
+
+import os
+from collections import OrderedDict
+import numpy as np
+from obspy.core import UTCDateTime
+from rsam_store import RSAMPyramid, RSAMStore, pyramid_path, read_day_file
+
+DEFAULT_READER_BYTES = 256 * 1024 ** 2  # 256 MB
+DAY_RESOLUTION = 600  # resolution (s) of the day files
+YEAR_RESOLUTION = 86400  # resolution (s) of the yearly files
+
+
+class RSAMReader(object):
+    """
+    Reader of RSAM series returning NumPy (times, values) pairs.
+
+    stream_dir maps a stream to the name of its folder in rsam_dir (the
+    stream itself by default). band is the file name part after the
+    stream, e.g. 'band_pass_2.00-5.00' or 'bp_2.00-5.00', or '' for
+    unfiltered RSAM.
+    """
+
+    def __init__(self, rsam_dir, stream_dir=None, extension='.rsam', max_bytes=DEFAULT_READER_BYTES):
+        self.rsam_dir = rsam_dir
+        self.stream_dir = stream_dir if stream_dir is not None else lambda stream: stream
+        self.extension = extension
+        self.max_bytes = max_bytes
+        self.cache = OrderedDict()  # (times, values) keyed by path, least recently used first
+        self.cache_bytes = 0
+        self.decoded = 0  # number of files decoded, for checking cache use
+
+    def path(self, stream, band, time, resolution=DAY_RESOLUTION):
+        """
+        Return the path of the file holding a stream and band's values at a time.
+        """
+        time = UTCDateTime(time)
+        name = stream + ('.' + band if band else '') + self.extension
+        directory = os.path.join(self.rsam_dir, self.stream_dir(stream))
+        if resolution == DAY_RESOLUTION:
+            return os.path.join(directory, time.strftime('%Y.%j') + '.' + name)
+        if resolution == YEAR_RESOLUTION:
+            return os.path.join(directory, time.strftime('%Y') + '.' + name)
+        return pyramid_path(os.path.join(directory, 'YYYY.JJJ.' + name), resolution)
+
+    def pyramid(self, stream, band):
+        """
+        Return the RSAMPyramid of a stream and band.
+        """
+        name = stream + ('.' + band if band else '') + self.extension
+        return RSAMPyramid(os.path.join(self.rsam_dir, self.stream_dir(stream), 'YYYY.JJJ.' + name))
+
+    def paths(self, stream, band, starttime, endtime, resolution=DAY_RESOLUTION, pixels=None):
+        """
+        Return the paths of the files a read of a stream and band between the times uses, whether they exist or not.
+        """
+        starttime = UTCDateTime(starttime)
+        endtime = UTCDateTime(endtime)
+        if resolution not in (DAY_RESOLUTION, YEAR_RESOLUTION):
+            return [self.path(stream, band, starttime, resolution)]
+        paths = []
+        if pixels is not None:
+            paths = [store.path for store in self.pyramid(stream, band).stores]
+        time = UTCDateTime(starttime.date) if resolution == DAY_RESOLUTION else UTCDateTime(starttime.year, 1, 1)
+        while time < endtime:
+            paths.append(self.path(stream, band, time, resolution))
+            time = time + 86400 if resolution == DAY_RESOLUTION else UTCDateTime(time.year + 1, 1, 1)
+        return paths
+
+    def decode(self, path):
+        """
+        Return (times, values) of the traces of a miniSEED RSAM file in time order, times in POSIX seconds.
+
+        None if the file is missing, empty or unreadable.
+        """
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        key = (stat.st_mtime, stat.st_size)
+        if path in self.cache:
+            cached_key, times, values = self.cache.pop(path)
+            if cached_key == key:
+                self.cache[path] = (key, times, values)  # most recently used
+                return times, values
+            self.cache_bytes -= times.nbytes + values.nbytes
+        st = read_day_file(path)
+        if st is None:
+            return None
+        st.sort(['starttime'])
+        times = np.concatenate([tr.stats.starttime.timestamp + np.arange(tr.stats.npts) * tr.stats.delta
+                                for tr in st])
+        values = np.concatenate([np.asarray(tr.data, dtype=np.float64) for tr in st])
+        self.decoded += 1
+        self.cache[path] = (key, times, values)
+        self.cache_bytes += times.nbytes + values.nbytes
+        while self.cache_bytes > self.max_bytes and len(self.cache) > 1:
+            _, (_, old_times, old_values) = self.cache.popitem(last=False)
+            self.cache_bytes -= old_times.nbytes + old_values.nbytes
+        return times, values
+
+    def read(self, stream, band, starttime, endtime, resolution=DAY_RESOLUTION, pixels=None):
+        """
+        Return (times, values) of a stream and band from starttime up to, not including, endtime.
+
+        times is a datetime64[us] array (UTC). resolution is DAY_RESOLUTION
+        for the day files, YEAR_RESOLUTION for the yearly files, or the
+        delta of a pyramid level. With pixels given the values are instead
+        read from the coarsest pyramid level giving at least pixels values
+        between the times, if the pyramid covers starttime. Missing, empty
+        and unreadable files are skipped, so times may have gaps.
+        """
+        starttime = UTCDateTime(starttime)
+        endtime = UTCDateTime(endtime)
+        store = None
+        if pixels is not None:
+            store = self.pyramid(stream, band).level(starttime, endtime, pixels)
+            if store.header is None or store.starttime > starttime:
+                store = None  # No pyramid, or one started since, so read the day or yearly files
+        elif resolution not in (DAY_RESOLUTION, YEAR_RESOLUTION):
+            store = RSAMStore(self.path(stream, band, starttime, resolution))
+            if store.header is None:
+                return np.zeros(0, 'datetime64[us]'), np.zeros(0)
+        if store is not None:
+            first, values = store.read(max(starttime, store.starttime), min(endtime, store.endtime))
+            times = first.timestamp + np.arange(len(values)) * store.delta
+        else:
+            series = [self.decode(path) for path in self.paths(stream, band, starttime, endtime, resolution)]
+            series = [pair for pair in series if pair is not None]
+            if not series:
+                return np.zeros(0, 'datetime64[us]'), np.zeros(0)
+            times = np.concatenate([times for times, _ in series])
+            values = np.concatenate([values for _, values in series])
+            inside = (times >= starttime.timestamp) & (times < endtime.timestamp)
+            times = times[inside]
+            values = values[inside]
+        return (np.round(times * 1e6).astype(np.int64)).astype('datetime64[us]'), np.asarray(values)
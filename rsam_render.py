@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+# rsam_render.py
+# helpers for drawing RSAM series in the plotting scripts
+
+# long series are reduced to a min/max envelope before drawing: the time
+# range is divided into one column per pixel of the axes at ENVELOPE_DPI and
+# only the smallest and largest value of each column are kept, in time
+# order, so every peak is still drawn while the number of points (and the
+# size of SVG paths) is bounded by the axes width, not the range length
+
+# plots are drawn with the object-oriented Figure API on their own Agg
+# canvas, without pyplot's global figure list, so a figure is released as
+# soon as it is saved; render_plots draws many plots in a process pool, one
+# process per plot
+
+# the memory reported for a plot is the growth of its process's resident
+# memory from the start of drawing to the saved figure, before the figure is
+# released (the peak resident memory is not used: in a forked process it
+# includes the calculation's pages, and Linux can only reset it for the
+# whole process); without /proc (not Linux) it is the peak of the process
+# so far
+
+# plot_payload is the light alternative to rendering: the envelopes of the
+# series, the threshold zones and the marked events of a plot as compact JSON
+# (typed arrays in base64), drawn in the browser by rsam_viewer.html, which
+# pans and zooms without asking the server for anything more
+
+# PlotCache keeps a copy of each plot's output files with a fingerprint of
+# its inputs (the path and content hash of every source file, present or
+# not, and the plot's parameters); when a plot is asked for again with the
+# same fingerprint the copies are reused instead of rendering it, so source
+# files rewritten with the same values (as rsamtools.py does each run) do
+# not force a render
+
+import base64
+import datetime
+import hashlib
+import json
+import math
+import os
+import resource
+import shutil
+import time
+from multiprocessing import cpu_count, Pool
+import numpy as np
+import pytz
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.dates import date2num
+from matplotlib.figure import Figure
+
+ENVELOPE_DPI = 200  # pixel density (per inch) the envelope is resolved to, independent of the saved dpi
+PLOT_CACHE_MAX_AGE = 7 * 86400  # time (s) an unused cached plot is kept
+PAYLOAD_COLUMNS = 4000  # envelope columns of a JSON payload series, enough to zoom in on a wide screen
+PAYLOAD_VERSION = 1
+PLOT_SIZE = (15, 5)  # figure size (inches) of the RSAM plots
+PLOT_AXES = [0.1, 0.2, 0.85, 0.7]  # axes rectangle of the RSAM plots, as a fraction of the figure
+DEFAULT_YMAX = 1000  # top of the y axis (nm/s) of a plot with no values, e.g. every window below min coverage
+
+
+def plot_columns(fig, ax, dpi=ENVELOPE_DPI):
+    """
+    Return the number of pixel columns across an axes at dpi.
+    """
+    return max(int(round(ax.get_position().width * fig.get_figwidth() * dpi)), 1)
+
+
+def plot_pixels(size=PLOT_SIZE, axes=PLOT_AXES, dpi=ENVELOPE_DPI):
+    """
+    Return the number of pixel columns across the axes of a plot before it is drawn, as plot_columns does after.
+    """
+    return max(int(round(axes[2] * size[0] * dpi)), 1)
+
+
+def plot_ymax(*series):
+    """
+    Return the top of the y axis for value arrays: 1.1 times their largest value, or DEFAULT_YMAX if they have none.
+    """
+    values = np.concatenate([np.asarray(data, dtype=np.float64).ravel() for data in series] + [np.zeros(0)])
+    values = values[np.isfinite(values)]
+    if len(values) == 0 or values.max() <= 0:
+        return DEFAULT_YMAX
+    return 1.1 * values.max()
+
+
+def minmax_envelope(times, values, columns):
+    """
+    Return (times, values) reduced to the minimum and maximum value of each of columns equal time spans.
+
+    times must be in increasing order (numbers or datetime64). The two
+    kept points of a column are its min and max samples in time order; a
+    column of only NaN values keeps one NaN so lines still break at gaps.
+    Series of no more than 2 * columns points are returned unchanged.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) <= 2 * columns:
+        return times, values
+    t = np.asarray(times)
+    t = t.astype('datetime64[us]').astype(np.int64) if np.issubdtype(t.dtype, np.datetime64) else t
+    t = t.astype(np.float64)
+    column = np.minimum(((t - t[0]) / max(t[-1] - t[0], 1e-12) * columns).astype(np.int64), columns - 1)
+    valid = np.isfinite(values)
+    starts = np.flatnonzero(np.r_[True, column[1:] != column[:-1]])  # first sample of each non-empty column
+
+    # Sort each column's samples by value so its first is the min (or max), NaN last
+
+    low = np.lexsort((np.where(valid, values, np.inf), column))[starts]
+    high = np.lexsort((np.where(valid, -values, np.inf), column))[starts]
+    keep = np.sort(np.unique(np.concatenate([low, high])))
+    return np.asarray(times)[keep], values[keep]
+
+
+def memory_status(field):
+    """
+    Return a memory field (e.g. 'VmRSS', 'VmHWM') of /proc/self/status in MB, or None without /proc.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return None
+
+
+def threshold_zones(base_trig):
+    """
+    Return the (bottom, top, colour, label) RSAM zones of a base trigger level, top None where unbounded.
+
+    base_trig 'null' has no zones.
+    """
+    if base_trig == 'null':
+        return []
+    bt = float(base_trig)
+    return [(0, bt / 2, 'green', 'Weak RSAM zone'),
+            (bt / 2, bt, 'orange', 'Moderate RSAM zone'),
+            (bt, None, 'red', 'Strong RSAM zone')]
+
+
+def render_rsam_plot(plot):
+    """
+    Draw and save one RSAM plot, returning (path, render seconds, memory in MB used drawing it).
+
+    plot is a dict of 'path', 'title', 'base_trig' (a level or 'null'),
+    'dpi' and 'series', a list of (times, values, label, linestyle) per
+    band with times as datetime64.
+    """
+    start_memory = memory_status('VmRSS')
+    render_start = time.time()
+    fig = Figure(figsize=PLOT_SIZE)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes(PLOT_AXES)
+
+    # Add base trigger level on plot
+
+    if plot['base_trig'] != 'null':
+        ax.axhline(y=float(plot['base_trig']),
+                   linestyle='--',
+                   color='red',
+                   label='RSAM alert value')
+
+        # Colour areas based on relation to BTL
+
+        for bottom, top, colour, label in threshold_zones(plot['base_trig']):
+            ax.axhspan(bottom,
+                       top if top is not None else 100000,
+                       alpha=0.1,
+                       color=colour,
+                       label=label)
+
+    # Plot data
+
+    for times, data, label, linestyle in plot['series']:
+        if len(times) == 0:
+            continue
+
+        # Build plot ticks
+
+        series_start = times[0].astype(datetime.datetime)
+        series_end = times[-1].astype(datetime.datetime)
+        plot_range = (series_end - series_start).total_seconds() / 86400
+        tick_range = math.ceil(plot_range)
+        second_offset = 86400 - (series_start.hour * 3600 +
+                                 series_start.minute * 60 +
+                                 series_start.second +
+                                 series_start.microsecond / 1000000)
+        xticks = []
+        xtick_labels = []
+        for m in range(tick_range):
+            xticks.append((series_start +
+                           datetime.timedelta(seconds=second_offset) +
+                           datetime.timedelta(days=m)).astimezone(pytz.timezone('Pacific/Auckland')).date())
+            if m % 2 == 0:
+                xtick_labels.append(str(xticks[-1]))
+            else:
+                xtick_labels.append('')
+
+        # Draw the min/max envelope of each pixel column, keeping peaks visible
+
+        t = date2num(times)
+        env_times, env_data = minmax_envelope(times, data, plot_columns(fig, ax))
+        ax.plot(env_times,
+                env_data,
+                linewidth=1,
+                linestyle=linestyle,
+                marker='None',
+                color='black',
+                label=label)
+
+        # Add plot features
+
+        ax.set_title(plot['title'],
+                     y=1.03,
+                     fontdict={'fontsize': 14})
+        ax.tick_params(axis='y',
+                       labelsize=12)
+        ax.set_ylabel('ground velocity (nm/s)',
+                      fontsize=14,
+                      labelpad=10)
+        ax.set_ylim(bottom=0,
+                    top=plot_ymax(*[series[1] for series in plot['series']]))
+        ax.set_xticks(xticks)
+        ax.set_xticklabels(xtick_labels,
+                           rotation=30,
+                           ha='right',
+                           fontsize=12)
+        ax.set_xlabel('date (NZT)',
+                      fontsize=14,
+                      labelpad=5)
+        ax.set_xlim(t[0],
+                    t[-1])
+        ax.legend(loc='upper left')
+
+    # Save plot to file and release the figure
+
+    fig.savefig(plot['path'],
+                dpi=plot['dpi'],
+                format='png')
+    memory = memory_status('VmRSS')
+    if memory is None or start_memory is None:
+        memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # Peak of the process so far
+    else:
+        memory -= start_memory
+    fig.clear()
+    del fig, ax
+    render_time = time.time() - render_start
+    return plot['path'], render_time, memory
+
+
+def render_plots(plots, workers=None):
+    """
+    Render plots with render_rsam_plot, in a pool of workers processes each rendering one plot when workers > 1.
+
+    workers defaults to the number of CPUs.
+
+    Yields (path, render seconds, memory in MB used drawing it) as each plot is saved.
+    """
+    if workers is None:
+        workers = cpu_count()
+    if workers <= 1 or len(plots) <= 1:
+        for plot in plots:
+            yield render_rsam_plot(plot)
+        return
+    pool = Pool(min(workers, len(plots)), maxtasksperchild=1)
+    try:
+        for result in pool.imap_unordered(render_rsam_plot, plots):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def posix_seconds(time):
+    """
+    Return the POSIX seconds of a UTC time (naive datetime or datetime64).
+    """
+    return int(np.datetime64(time, 's').astype(np.int64))
+
+
+def encode_array(values, dtype):
+    """
+    Return the base64 text of the bytes of values as dtype, for decoding into a typed array in a browser.
+    """
+    return base64.b64encode(np.ascontiguousarray(values, dtype=dtype).tobytes()).decode('ascii')
+
+
+def plot_payload(plot, columns=PAYLOAD_COLUMNS):
+    """
+    Return the JSON payload of an RSAM plot drawn by rsam_viewer.html.
+
+    plot is a dict as for render_rsam_plot, optionally with 'events', a
+    list of (time, label) marked by labelled vertical lines, and 'spans', a
+    list of (start, end, colour, label) shaded across the axes, times as
+    UTC datetimes. Each series is reduced to its min/max envelope over
+    columns and its times and values are encoded as little-endian int32
+    seconds after its 'start' and float32 values, NaN at gaps.
+    """
+    series = []
+    for times, data, label, linestyle in plot['series']:
+        env_times, env_data = minmax_envelope(times, data, columns)
+        seconds = np.asarray(env_times, dtype='datetime64[s]').astype(np.int64)
+        start = int(seconds[0]) if len(seconds) else 0
+        series.append({'label': label,
+                       'linestyle': linestyle,
+                       'start': start,
+                       'times': encode_array(seconds - start, '<i4'),
+                       'values': encode_array(env_data, '<f4')})
+    return {'version': PAYLOAD_VERSION,
+            'title': plot['title'],
+            'xlabel': 'date (NZT)',
+            'ylabel': 'ground velocity (nm/s)',
+            'timezone': 'Pacific/Auckland',
+            'alert': float(plot['base_trig']) if plot['base_trig'] != 'null' else None,
+            'zones': [{'bottom': bottom, 'top': top, 'colour': colour, 'label': label}
+                      for bottom, top, colour, label in threshold_zones(plot['base_trig'])],
+            'events': [{'time': posix_seconds(time), 'label': label} for time, label in plot.get('events', [])],
+            'spans': [{'start': posix_seconds(start), 'end': posix_seconds(end), 'colour': colour, 'label': label}
+                      for start, end, colour, label in plot.get('spans', [])],
+            'series': series}
+
+
+def write_plot_payload(plot, path, columns=PAYLOAD_COLUMNS):
+    """
+    Write the JSON payload of an RSAM plot to path, returning (path, seconds taken).
+    """
+    write_start = time.time()
+    with open(path + '.tmp', 'w') as f:
+        json.dump(plot_payload(plot, columns), f, separators=(',', ':'))
+    os.rename(path + '.tmp', path)
+    return path, time.time() - write_start
+
+
+def file_state(path):
+    """
+    Return (path, SHA-1 of contents) of a file, with None for the hash if it does not exist.
+    """
+    if not os.path.isfile(path):
+        return [path, None]
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 ** 2), b''):
+            digest.update(block)
+    return [path, digest.hexdigest()]
+
+
+class PlotCache(object):
+    """
+    Copies of rendered plots reused while the fingerprint of their inputs is unchanged.
+
+    A plot is identified by its parameters alone and its fingerprint also
+    covers its source files, so each plot keeps only its latest copy.
+    Copies unused for max_age seconds are removed.
+    """
+
+    def __init__(self, directory, max_age=PLOT_CACHE_MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+
+    def key(self, parameters):
+        """
+        Return the name of a plot's files in the cache.
+        """
+        return hashlib.sha1(json.dumps(parameters, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def fingerprint(self, parameters, paths):
+        """
+        Return the fingerprint of a plot's parameters and source files.
+        """
+        inputs = {'parameters': parameters,
+                  'files': sorted(file_state(path) for path in set(paths))}
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def copy_path(self, key, output):
+        """
+        Return the path of the cached copy of an output file.
+        """
+        return os.path.join(self.directory, key + os.path.splitext(output)[1])
+
+    def fetch(self, parameters, fingerprint, outputs):
+        """
+        Copy a plot's cached output files into place if its fingerprint is unchanged. Returns True if they were.
+        """
+        key = self.key(parameters)
+        fingerprint_path = os.path.join(self.directory, key + '.fingerprint')
+        if not os.path.isfile(fingerprint_path):
+            return False
+        with open(fingerprint_path) as f:
+            if f.read() != fingerprint:
+                return False
+        copies = [self.copy_path(key, output) for output in outputs]
+        if not all(os.path.isfile(copy) for copy in copies):
+            return False
+        for copy, output in zip(copies, outputs):
+            shutil.copyfile(copy, output)
+        os.utime(fingerprint_path, None)  # mark as recently used
+        return True
+
+    def store(self, parameters, fingerprint, outputs):
+        """
+        Keep copies of a plot's freshly rendered output files with its fingerprint, taken before reading its inputs.
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        key = self.key(parameters)
+        for output in outputs:
+            shutil.copyfile(output, self.copy_path(key, output))
+        with open(os.path.join(self.directory, key + '.fingerprint.tmp'), 'w') as f:
+            f.write(fingerprint)
+        os.rename(os.path.join(self.directory, key + '.fingerprint.tmp'),
+                  os.path.join(self.directory, key + '.fingerprint'))  # written last, so copies are complete
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the copies of plots whose fingerprint was last used more than max_age seconds ago.
+        """
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith('.fingerprint'):
+                continue
+            path = os.path.join(self.directory, name)
+            if now - os.path.getmtime(path) > self.max_age:
+                key = name[:-len('.fingerprint')]
+                for other in os.listdir(self.directory):
+                    if other.startswith(key + '.'):
+                        os.remove(os.path.join(self.directory, other))
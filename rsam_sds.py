@@ -6,15 +6,14 @@
 #file length is (approximately) one day, can be a few seconds over or under so
 #file does not contain exactly 144 x 10 minute segments
 
-import numpy as np
 import sys
 from subprocess import call
 import os
-import obspy
-from obspy.core import read, Trace, Stream, UTCDateTime
-from obspy.clients.fdsn import Client
+from obspy.core import read, Trace, Stream
 import datetime as dt
-import urllib2
+from rsam_engine import design_filter, response_rsam, trace_rsam
+from rsam_fetch import fetch_day, fetch_resp, WaveformCache
+from rsam_store import update_day_index
 
 #location of geonet response files
 respdir = 'ftp://ftp.geonet.org.nz/seed/RESPONSE'
@@ -39,10 +38,6 @@ elif len(sys.argv) == 9:  #filter = bp, two frequencies given
   f1 = float(sys.argv[7])
   f2 = float(sys.argv[8])
 
-#initialise data array for rsam values
-#one extra element, just in case
-data = np.zeros(145)
-
 #get data file name and location
 net = str.split(stream, '.')[2]	#NZ
 site = str.split(stream, '.')[0]	#DRZ
@@ -53,30 +48,21 @@ dd = dt.datetime.strptime(date, '%Y%m%d')	#into correct format
 data_dir = '/tmp'
 name = net + '.' + site + '.' + loc + '.' + cmp + '.' + 'D' + '.' + dd.strftime("%Y.%j")	#NZ.WIZ.10.HHZ.D.2013.121
 datafile = os.path.join(data_dir, name)	#/geonet/seismic/sds/2013/NZ/WIZ/HHZ.D/NZ.WIZ.10.HHZ.D.2013.121
+#completed days are kept in an SDS layout waveform cache under data_dir
 if net == 'NZ':
-    c = Client(base_url='http://beta-service-nrt.geonet.org.nz')
-    start = UTCDateTime(dd)
-    end = start + 86400
-    try:
-        s = c.get_waveforms(net,site,loc,cmp,start,end)
-    except obspy.io.mseed.ObsPyMSEEDFilesizeTooSmallError:
-	sys.stderr.write("No data found for %s\n"%('.'.join((net, site, loc, cmp))))
-	sys.exit(0)
-    s.write(datafile,'MSEED')
+    services = ['http://beta-service-nrt.geonet.org.nz']
     if False:
         # For NZ stations use CWB until FDSN is stable
         NSCL = '{0:.<2s}{1:.<5s}{2:.<3s}{3:.<2s}'.format(net,site,cmp,loc)
         cwb_cmd = ['java','-jar',cwb_bin, '-t','ms','-d','1d','-b',dd.strftime("%Y/%m/%d %H:%M:%S"),'-s',nscl,'-o',datafile]
         call(cwb_cmd)
-elif net == 'IU':
-    # For IU use IRIS FDSNws
-    c = Client('IRIS')
-    start = UTCDateTime(dd)
-    end = start + 86400
-    s = c.get_waveforms(net,site,loc,cmp,start,end)
-    s.write(datafile,'MSEED')
 else:
-    raise Exception("Don't know how to request data for network {:s}".format(net))
+    services = None  # default services for the network, IRIS FDSNws for IU
+s = fetch_day(net, site, loc, cmp, dd, cache=WaveformCache(base_dir), services=services)
+if s is None:
+    sys.stderr.write("No data found for %s\n"%('.'.join((net, site, loc, cmp))))
+    sys.exit(0)
+s.write(datafile,'MSEED')
 
 #check if data file exists
 if not os.path.isfile(datafile):
@@ -99,14 +85,10 @@ starttime = tr.stats.starttime	#2005-10-06T07:21:59.849998Z
 if resp == 'resp':
   #response file name
   respfile = os.path.join(respdir, station + '.' + network, 'RESP' + '.' + network + '.' + station + '.' + location + '.' + channel)
-  #get response file, store locally as file called respfile
-  response = urllib2.urlopen(respfile)
-  file = 'respfile'
-  fh = open(file, "w")
-  fh.write(response.read())
-  fh.close()
+  #get response file, kept locally under out_dir/resp between runs
+  respfile = fetch_resp(respfile, os.path.join(out_dir, 'resp'))
   #response info
-  seedresp = {'filename': 'respfile', 'date': starttime, 'units': 'VEL'}
+  seedresp = {'filename': respfile, 'date': starttime, 'units': 'VEL'}
   # define a filter band to prevent amplifying noise during the deconvolution
   #wide values 'typical' short-period rsam
   fl1 = 0.005
@@ -132,46 +114,22 @@ rsamfile = os.path.join(out_dir, site + '.' + net, rsam_name)	#out_dir/DRZ.CH/20
 if not os.path.exists(rsampath):
   os.makedirs(rsampath)
 
-t = tr.stats.starttime
-index = 0
-#loop through data in 600sec (10 min) blocks
-while t < tr.stats.endtime:
-  tr_10m = tr.slice(t, t + 600)
-
-  duration = tr_10m.stats.npts * tr_10m.stats.delta
-  #print index, duration
-  if duration >= 500:
-    if duration < 600:
-      tr_10m = tr.slice(tr.stats.endtime - 600, tr.stats.endtime) 
-    #correct response?
-    if resp == 'resp':
-      tr_10m.simulate(paz_remove=None, pre_filt=(fl1, fl2, fl3, fl4), seedresp=seedresp)
-
-    #detrend and filter
-    tr_10m.detrend(type='constant')
-    if filtype == 'lp':
-      #print 'lowpass'
-      tr_10m.filter('lowpass', freq=f, corners=4, zerophase=False)
-    elif filtype == 'hp':
-      #print 'highpass'
-      tr_10m.filter('highpass', freq=f, corners=4, zerophase=False)
-    elif filtype == 'bp':
-      #print 'bandpass'
-      tr_10m.filter('bandpass', freqmin=f1, freqmax=f2, corners=4, zerophase=False)
-
-    absolute = np.absolute(tr_10m.data)	#absolute value
-    tr_10m.data = absolute	#assign back to trace
-    mean = tr_10m.data.mean()
-    if resp == 'resp':
-      mean = mean / 1e-9	#convert to nanometres so dealing with whole numbers
-    data[index] = mean
-    index += 1
-    #end if 
-  t += 600
-#end loop through data in 600sec (10 min) blocks
+#rsam values from 600sec (10 min) blocks of the data
+if filtype == 'lp':
+  sos = design_filter('lowpass', tr.stats.sampling_rate, freq=f)
+elif filtype == 'hp':
+  sos = design_filter('highpass', tr.stats.sampling_rate, freq=f)
+elif filtype == 'bp':
+  sos = design_filter('bandpass', tr.stats.sampling_rate, freqmin=f1, freqmax=f2)
+else:
+  sos = None
 
-#resize data to remove any unused elements
-data = np.resize(data, index)
+if resp == 'resp':
+  #response is evaluated once and removed from every window, then windows are detrended and filtered
+  data = response_rsam(tr, seedresp, pre_filt=(fl1, fl2, fl3, fl4), sos=sos)
+  data = data / 1e-9	#convert to nanometres so dealing with whole numbers
+else:
+  data = trace_rsam(tr, sos)
 
 #write mseed format file
 #mseed header attributes
@@ -181,3 +139,4 @@ stats = {'network': network, 'station': station, 'location': location,
          'mseed': {'dataquality': 'D'}, 'starttime': starttime}
 st = Stream([Trace(data=data, header=stats)])
 st.write(rsamfile, format='MSEED', reclen=256)
+update_day_index(rsamfile, st[0])	#daily summary for the year file
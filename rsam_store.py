@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+# rsam_store.py
+# append-only fixed grid storage of RSAM series, one file per stream and band
+
+# a store file holds a HEADER_BYTES JSON header padded with spaces, followed
+# by little-endian float64 values, one per delta seconds from the header's
+# start (the UTC midnight of the first day written); slots without a value
+# are NaN, so the position of a value is a function of its time alone and
+# any time range is one contiguous slice of the file, readable with np.memmap
+
+# values written with a starttime off the grid (e.g. from day files whose
+# windows start at the first sample) are placed at the nearest slot
+
+# store files sit next to the day files, named as the day files without the
+# YYYY.JJJ. prefix plus STORE_EXTENSION, e.g.
+# NZ.WIZ.10.HHZ.band_pass_2.00-5.00.rsam.store
+
+# a pyramid keeps one series at several resolutions, a store per level in
+# PYRAMID_LEVELS named with the level's delta, e.g.
+# NZ.WIZ.10.HHZ.band_pass_2.00-5.00.rsam.60s.store; values are written to the
+# finest level and each coarser slot they touch is recalculated as the NaN
+# ignoring mean of the finer slots it holds, so levels stay in step with
+# every incremental write
+
+# the summary statistics of every day file written (mean, count and coverage
+# of its values, min and max) are kept in a JSON index per stream and band
+# next to the day files, named as the store file with INDEX_EXTENSION, so
+# yearly daily mean files are built without reading the day files again
+
+import json
+import os
+import tempfile
+import numpy as np
+from obspy.core import read, Trace, Stream, UTCDateTime
+
+HEADER_BYTES = 256
+STORE_EXTENSION = '.store'
+INDEX_EXTENSION = '.days.json'
+STORE_VERSION = 1
+PYRAMID_LEVELS = (60, 600, 3600, 86400)  # deltas (s) of the pyramid levels, finest first, each dividing the next
+DTYPE = np.dtype('<f8')
+
+
+def store_path(rsam_file_path):
+    """
+    Return the path of the store file holding the series of a YYYY.JJJ.<stream>.<band>.rsam day file.
+    """
+    directory, name = os.path.split(rsam_file_path)
+    return os.path.join(directory, name[len('YYYY.JJJ.'):] + STORE_EXTENSION)
+
+
+class RSAMStore(object):
+    """
+    One RSAM series on a fixed time grid, appendable in place.
+
+    The file is created by the first write. Writes after the end of the
+    series extend the file, filling any slots in between with NaN; writes
+    before its start rewrite the file once with an earlier start.
+    """
+
+    def __init__(self, path, delta=600):
+        self.path = path
+        self.delta = delta
+        self.header = None
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                self.header = json.loads(f.read(HEADER_BYTES).decode('ascii'))
+            if self.header['version'] != STORE_VERSION:
+                raise Exception('Unknown RSAM store version {:d} in {:s}'.format(self.header['version'], path))
+            self.delta = self.header['delta']
+
+    @property
+    def starttime(self):
+        return UTCDateTime(self.header['start']) if self.header is not None else None
+
+    def __len__(self):
+        if self.header is None:
+            return 0
+        return (os.path.getsize(self.path) - HEADER_BYTES) // DTYPE.itemsize
+
+    @property
+    def endtime(self):
+        """Time of the slot after the last one stored."""
+        if self.header is None:
+            return None
+        return self.starttime + len(self) * self.delta
+
+    def index(self, time):
+        """
+        Return the slot of a time, counted from the start of the series (negative before it).
+        """
+        return int(np.floor((UTCDateTime(time) - self.starttime) / self.delta + 0.5))
+
+    def write_header(self, f, start, stats):
+        header = {'version': STORE_VERSION,
+                  'start': str(start),
+                  'delta': self.delta,
+                  'network': stats.get('network', ''),
+                  'station': stats.get('station', ''),
+                  'location': stats.get('location', ''),
+                  'channel': stats.get('channel', '')}
+        text = json.dumps(header).encode('ascii')
+        if len(text) > HEADER_BYTES:
+            raise Exception('RSAM store header too long for ' + self.path)
+        f.write(text.ljust(HEADER_BYTES))
+        self.header = header
+
+    def rebase(self, start):
+        """
+        Rewrite the file to start at an earlier UTC midnight, NaN filling the new leading slots.
+        """
+        values = self.read()[1]
+        lead = int(round((self.starttime - start) / self.delta))
+        with open(self.path + '.tmp', 'wb') as f:
+            self.write_header(f, start, self.header)
+            np.full(lead, np.nan, DTYPE).tofile(f)
+            values.astype(DTYPE).tofile(f)
+        os.rename(self.path + '.tmp', self.path)  # so readers never see a partial file
+
+    def write(self, starttime, data, stats=None):
+        """
+        Write values every delta seconds from starttime into the series, replacing any stored in their slots.
+
+        stats (e.g. a Trace's stats) gives the NSLC recorded in the header
+        of a new file.
+        """
+        data = np.asarray(data, dtype=DTYPE)
+        starttime = UTCDateTime(starttime)
+        if self.header is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(self.path, 'wb') as f:
+                self.write_header(f, UTCDateTime(starttime.date), stats or {})
+        elif starttime < self.starttime - self.delta / 2.0:
+            self.rebase(UTCDateTime(starttime.date))
+        first = self.index(starttime)
+        length = len(self)
+        with open(self.path, 'r+b') as f:
+            if first > length:
+                f.seek(HEADER_BYTES + length * DTYPE.itemsize)
+                np.full(first - length, np.nan, DTYPE).tofile(f)
+            f.seek(HEADER_BYTES + first * DTYPE.itemsize)
+            data.tofile(f)
+
+    def write_trace(self, tr):
+        """
+        Write the values of an RSAM Trace into the series.
+        """
+        self.write(tr.stats.starttime, tr.data, tr.stats)
+
+    def read(self, starttime=None, endtime=None):
+        """
+        Return (starttime, values) of the slots from starttime up to, not including, endtime.
+
+        values is a read-only memory-mapped slice of the file, NaN where no
+        value was stored, including any part of the range outside the
+        series (then a copy). Without times the whole series is returned.
+        """
+        if self.header is None:
+            raise Exception('No RSAM store at ' + self.path)
+        length = len(self)
+        first = 0 if starttime is None else self.index(starttime)
+        last = length if endtime is None else self.index(endtime)
+        last = max(last, first)
+        values = np.memmap(self.path, dtype=DTYPE, mode='r', offset=HEADER_BYTES, shape=(length,)) if length else \
+            np.zeros(0, DTYPE)
+        if first < 0 or last > length:
+            out = np.full(last - first, np.nan)
+            inside = slice(max(first, 0), min(max(last, 0), length))
+            if inside.stop > inside.start:
+                out[inside.start - first:inside.stop - first] = values[inside]
+            values = out
+        else:
+            values = values[first:last]
+        return self.starttime + first * self.delta, values
+
+    def read_trace(self, starttime=None, endtime=None):
+        """
+        Return the slots from starttime up to endtime as an RSAM Trace.
+        """
+        starttime, values = self.read(starttime, endtime)
+        stats = {'network': self.header['network'],
+                 'station': self.header['station'],
+                 'location': self.header['location'],
+                 'channel': self.header['channel'],
+                 'npts': len(values),
+                 'delta': self.delta,
+                 'mseed': {'dataquality': 'D'},
+                 'starttime': starttime}
+        return Trace(data=np.array(values), header=stats)
+
+
+def pyramid_path(rsam_file_path, delta):
+    """
+    Return the path of the store file of one pyramid level of the series of a day file.
+    """
+    directory, name = os.path.split(rsam_file_path)
+    return os.path.join(directory, name[len('YYYY.JJJ.'):] + '.{:d}s'.format(delta) + STORE_EXTENSION)
+
+
+def roll_up(values, factor):
+    """
+    Return the NaN ignoring means of consecutive groups of factor values, NaN for groups without any.
+    """
+    groups = np.asarray(values, dtype=np.float64).reshape(-1, factor)
+    count = np.isfinite(groups).sum(axis=1)
+    total = np.where(np.isfinite(groups), groups, 0).sum(axis=1)
+    return np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+
+class RSAMPyramid(object):
+    """
+    One RSAM series at every resolution of PYRAMID_LEVELS.
+    """
+
+    def __init__(self, rsam_file_path, levels=PYRAMID_LEVELS):
+        self.levels = levels
+        self.stores = [RSAMStore(pyramid_path(rsam_file_path, delta), delta=delta) for delta in levels]
+
+    def write(self, starttime, data, stats=None):
+        """
+        Write finest level values every levels[0] seconds from starttime and roll them up into the coarser levels.
+
+        Leading and trailing NaN values are not written, so a partly
+        calculated day grid leaves the values stored around it in place.
+        """
+        data = np.asarray(data, dtype=np.float64)
+        valid = np.flatnonzero(np.isfinite(data))
+        if len(valid) == 0:
+            return
+        starttime = UTCDateTime(starttime) + valid[0] * self.levels[0]
+        endtime = starttime + (valid[-1] - valid[0] + 1) * self.levels[0]
+        self.stores[0].write(starttime, data[valid[0]:valid[-1] + 1], stats)
+        for finer, coarser in zip(self.stores[:-1], self.stores[1:]):
+            starttime = UTCDateTime(np.floor(starttime.timestamp / coarser.delta) * coarser.delta)
+            endtime = UTCDateTime(np.ceil(endtime.timestamp / coarser.delta) * coarser.delta)
+            values = finer.read(starttime, endtime)[1]
+            coarser.write(starttime, roll_up(values, int(coarser.delta // finer.delta)), stats)
+
+    def level(self, starttime, endtime, pixels=None):
+        """
+        Return the store of the coarsest level giving at least pixels values between the times, the finest without.
+        """
+        if pixels is not None:
+            for store in self.stores[::-1]:
+                if store.header is not None and (UTCDateTime(endtime) - UTCDateTime(starttime)) / store.delta >= pixels:
+                    return store
+        return self.stores[0]
+
+    def read(self, starttime, endtime, pixels=None):
+        """
+        Return (starttime, delta, values) of the level chosen by level() between the times.
+        """
+        store = self.level(starttime, endtime, pixels)
+        starttime, values = store.read(starttime, endtime)
+        return starttime, store.delta, values
+
+
+def read_day_file(rsam_file_path):
+    """
+    Return the Stream of a day file, or None if it is missing, empty or unreadable.
+
+    An interrupted or empty write leaves a file obspy cannot read, which is
+    treated as if the day had not been written.
+    """
+    if not os.path.isfile(rsam_file_path) or os.path.getsize(rsam_file_path) == 0:
+        return None
+    try:
+        st = read(rsam_file_path)
+    except Exception as e:
+        print('Ignoring unreadable RSAM file ' + rsam_file_path + ': ' + str(e))
+        return None
+    return st if len(st) else None
+
+
+def import_day_file(rsam_file_path):
+    """
+    Write the values of a day file into its store, returning the number of values written.
+    """
+    st = read_day_file(rsam_file_path)
+    if st is None:
+        return 0
+    store = RSAMStore(store_path(rsam_file_path), delta=st[0].stats.delta)
+    for tr in st:
+        store.write_trace(tr)
+    return sum(tr.stats.npts for tr in st)
+
+
+def export_day_file(rsam_file_path, day):
+    """
+    Write a day file from its store, returning False if the store holds no values for the day.
+
+    Slots without a value before the first and after the last value of
+    the day are left out; those in between are written as NaN.
+    """
+    store = RSAMStore(store_path(rsam_file_path))
+    if store.header is None:
+        return False
+    day = UTCDateTime(day)
+    tr = store.read_trace(day, day + 86400)
+    valid = np.flatnonzero(np.isfinite(tr.data))
+    if len(valid) == 0:
+        return False
+    tr.data = tr.data[valid[0]:valid[-1] + 1]
+    tr.stats.starttime += valid[0] * tr.stats.delta
+    Stream([tr]).write(rsam_file_path, format='MSEED', reclen=256)
+    update_day_index(rsam_file_path, tr)
+    return True
+
+
+def index_path(rsam_file_path):
+    """
+    Return the path of the daily summary index of the series of a YYYY.JJJ.<stream>.<band>.rsam day file.
+    """
+    directory, name = os.path.split(rsam_file_path)
+    return os.path.join(directory, name[len('YYYY.JJJ.'):] + INDEX_EXTENSION)
+
+
+def day_summary(tr):
+    """
+    Return the summary statistics of the values of an RSAM day Trace.
+
+    count is the number of values that are not NaN and coverage their
+    fraction of a full day of windows; mean, min and max are None when
+    the day has no values.
+    """
+    valid = tr.data[np.isfinite(tr.data)]
+    count = len(valid)
+    return {'start': str(tr.stats.starttime),
+            'network': tr.stats.network,
+            'station': tr.stats.station,
+            'location': tr.stats.location,
+            'channel': tr.stats.channel,
+            'mean': float(valid.mean()) if count else None,
+            'count': count,
+            'coverage': count * tr.stats.delta / 86400.0,
+            'min': float(valid.min()) if count else None,
+            'max': float(valid.max()) if count else None}
+
+
+class DaySummaryIndex(object):
+    """
+    Summary statistics of the day files of one RSAM series keyed by YYYY.JJJ.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.days = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.days = json.load(f)
+
+    def save(self):
+        """
+        Write the index through a temporary file of its own, so readers never see a partial file and processes
+        writing days of the same stream and band at once do not write to the same temporary file.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', prefix=os.path.basename(self.path) + '.',
+                                        suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.days, f, sort_keys=True)
+        os.chmod(tmp_path, 0o644)  # mkstemp makes the file private
+        os.replace(tmp_path, self.path)
+
+    def put(self, rsam_file_path, tr):
+        self.days[os.path.basename(rsam_file_path)[:len('YYYY.JJJ')]] = day_summary(tr)
+
+    def get(self, rsam_file_path):
+        """
+        Return the summary of a day file, reading it into the index if it is missing. None if there is no readable file.
+        """
+        key = os.path.basename(rsam_file_path)[:len('YYYY.JJJ')]
+        if key not in self.days:
+            st = read_day_file(rsam_file_path)
+            if st is None:
+                return None
+            st.merge(fill_value='interpolate')  # In case stream has more than one trace
+            self.put(rsam_file_path, st[0])
+        return self.days[key]
+
+
+def update_day_index(rsam_file_path, tr):
+    """
+    Record the summary of a day file's Trace, called whenever the day file is written.
+    """
+    index = DaySummaryIndex(index_path(rsam_file_path))
+    index.put(rsam_file_path, tr)
+    index.save()
+
+
+def day_summaries(rsam_file_paths):
+    """
+    Return the summaries of day files of one series from its index, None for days without a file.
+
+    Day files written before the index existed are read once and added.
+    """
+    index = DaySummaryIndex(index_path(rsam_file_paths[0]))
+    known = len(index.days)
+    summaries = [index.get(rsam_file_path) for rsam_file_path in rsam_file_paths]
+    if len(index.days) > known:
+        index.save()
+    return summaries
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""
+Convert RSAM series between the YYYY.JJJ.<stream>.<band>.rsam day files and the per stream and band store files
+of rsam_store.py.
+
+'import' writes the values of existing day files into the store files, 'export' writes day files from the store
+files.
+"""
+
+import argparse
+import datetime
+from obspy.core import UTCDateTime
+import os
+from rsam_store import export_day_file, import_day_file
+
+
+# Parse arguments from command line
+
+parser = argparse.ArgumentParser()
+parser.add_argument('direction',
+                    choices=['import', 'export'],
+                    help='Whether to import day files into the stores or export day files from them.')
+parser.add_argument('--streams',
+                    type=str,
+                    help='Streams(s) to convert RSAM data for. Format is a comma-separated list of '
+                         'NETWORK.SITE.LOC.CHANNEL strings, e.g. NZ.WIZ.10.HHZ,NZ.WSRZ.10.HHZ')
+parser.add_argument('--start-date',
+                    type=str,
+                    help='First date to convert. Format is YYYYMMDD in UTC.')
+parser.add_argument('--end-date',
+                    type=str,
+                    help='Last date to convert. Format is YYYYMMDD in UTC.')
+parser.add_argument('--filter-ranges',
+                    type=str,
+                    default='[,]',
+                    help='Frequency range of the RSAM to convert, set either bound to None to apply no limit on '
+                         'that bound. Give a comma-separated list of frequency bounds to convert multiple RSAM '
+                         'timeseries, e.g. [0,5],[5,10]')
+parser.add_argument('--spectral',
+                    action='store_true',
+                    help='Whether to convert spectral RSAM (.spectral.rsam files) instead of filtered RSAM.')
+parser.add_argument('--rsam-dir',
+                    type=str,
+                    default='./rsam_files',
+                    help='Directory holding a folder of RSAM files for each stream.')
+args = parser.parse_args()
+
+streams = args.streams.split(',')
+start_date = datetime.datetime.strptime(args.start_date, '%Y%m%d')
+end_date = datetime.datetime.strptime(args.end_date, '%Y%m%d')
+rsam_extension = '.spectral.rsam' if args.spectral else '.rsam'
+
+for stream in streams:
+
+    rsam_data_path = os.path.join(args.rsam_dir, stream)
+
+    frequency_ranges = args.filter_ranges.split('],[')
+    for frequency_range in frequency_ranges:
+        frequency_bounds = frequency_range.replace('[', '').replace(']', '').split(',')
+
+        # Define RSAM file name suffix
+
+        if not frequency_bounds[0] and not frequency_bounds[1]:
+            file_suffix = '.' + stream + rsam_extension
+        elif frequency_bounds[0] and not frequency_bounds[1]:
+            lower_bound = '%.2f' % float(frequency_bounds[0])  # String of lower frequency bound to 2 decimal places
+            file_suffix = '.' + stream + '.low_pass_' + lower_bound + rsam_extension
+        elif frequency_bounds[1] and not frequency_bounds[0]:
+            upper_bound = '%.2f' % float(frequency_bounds[1])  # String of upper frequency bound to 2 decimal places
+            file_suffix = '.' + stream + '.high_pass_' + upper_bound + rsam_extension
+        elif frequency_bounds[0] and frequency_bounds[1]:
+            lower_bound = '%.2f' % float(frequency_bounds[0])  # String of lower frequency bound to 2 decimal places
+            upper_bound = '%.2f' % float(frequency_bounds[1])  # String of upper frequency bound to 2 decimal places
+            file_suffix = '.' + stream + '.band_pass_' + lower_bound + '-' + upper_bound + rsam_extension
+
+        print(args.direction.capitalize() + 'ing RSAM values for ' + stream + ' between frequency bounds ' +
+              frequency_bounds[0] + '-' + frequency_bounds[1] + ' Hz')
+
+        # Convert each day of the date range, oldest first so imports append to the stores
+
+        num_days = 0
+        for n in range((end_date - start_date).days + 1):
+            day = UTCDateTime(start_date) + 86400 * n
+            rsam_file_path = os.path.join(rsam_data_path, day.strftime("%Y.%j") + file_suffix)
+            if args.direction == 'import':
+                if not os.path.isfile(rsam_file_path):
+                    print("Can't find file %s" % rsam_file_path)
+                    continue
+                import_day_file(rsam_file_path)
+                num_days += 1
+            elif export_day_file(rsam_file_path, day):
+                num_days += 1
+            else:
+                print('No stored values for ' + stream + ' on date ' + str(day)[:10])
+        print(args.direction.capitalize() + 'ed ' + str(num_days) + ' days')
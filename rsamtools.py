@@ -8,24 +8,24 @@ Can calculate an indefinite range of filtered RSAM timeseries, but can only plot
 
 import argparse
 import datetime
-import math
-import matplotlib
-matplotlib.use('Agg')
-linestyles = ['-', '--', '-.', ':']
-from matplotlib.dates import date2num
-from matplotlib.dates import num2date
-import matplotlib.dates as mdates
-from matplotlib.patches import Rectangle
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mticker
+from itertools import groupby
 import numpy as np
-from obspy.core import read, Trace, Stream, UTCDateTime
-from obspy.clients.fdsn import Client
+from obspy.core import Trace, Stream, UTCDateTime
 import os
-import pytz
-import scipy as sp
-import sys
-
+from rsam_reader import RSAMReader
+import rsam_reader
+import rsam_render
+import rsam_store
+from rsam_render import PlotCache, plot_pixels, render_plots, write_plot_payload
+from rsam_store import PYRAMID_LEVELS, day_summaries, read_day_file, RSAMPyramid, RSAMStore, store_path, \
+    update_day_index
+from rsam_fetch import client_timings, fetch_bulk, fetch_chunks, fetch_concurrently, fetch_since, SensitivityCache, \
+    WaveformCache
+from rsam_engine import MIN_DURATION, WARMUP, WINDOW, StreamingRSAM, band_filter, continuous_bank_rsam, \
+    decimation_accuracy, gap_bank_rsam, load_filter_state, load_spectra, rsam_bands, save_filter_state, \
+    save_spectra, spectral_bank_rsam, spectrum_edges, window_spectra
+
+linestyles = ['-', '--', '-.', ':']  # Line styles of the plotted frequency ranges
 
 # Parse arguments from command line
 
@@ -54,10 +54,140 @@ parser.add_argument('--filter-ranges',
                     help='Frequency range to filter the data to, set either bound to None to apply no filtering on '
                          'that bound. Give a comma-separated list of frequency bounds to produce multiple RSAM '
                          'timeseries, e.g. [0,5],[5,10]')
+parser.add_argument('--continuous-filter',
+                    action='store_true',
+                    help='Whether to filter each day of data in one continuous pass before cutting it into 10-minute '
+                         'windows, rather than filtering each window separately.')
+parser.add_argument('--filter-state',
+                    action='store_true',
+                    help='Whether to save the filter state at the end of each day and continue filtering from it on '
+                         'the next day. Only used with --continuous-filter.')
+parser.add_argument('--spectral',
+                    action='store_true',
+                    help='Whether to calculate spectral RSAM, integrating every frequency range from one FFT per '
+                         '10-minute window, instead of filtering the data. Spectral RSAM files end in .spectral.rsam.')
+parser.add_argument('--store-spectra',
+                    action='store_true',
+                    help='Whether to store log-binned power spectra of each 10-minute window alongside the RSAM files, '
+                         'so spectral RSAM for new frequency ranges can be derived with rsam_from_spectra.py.')
+parser.add_argument('--incremental',
+                    action='store_true',
+                    help='Whether to only calculate the 10-minute windows completed since the last run and append them '
+                         'to the existing RSAM files of the day. Only complete windows are written in this mode, until the data '
+                         'reaches the end of the day.')
+parser.add_argument('--cache-dir',
+                    type=str,
+                    default='./waveform_cache',
+                    help='Directory of the local SDS layout waveform cache for completed days. Set to an empty string '
+                         'to disable caching.')
+parser.add_argument('--cache-size',
+                    type=float,
+                    default=20,
+                    help='Largest size of the waveform cache in GB, least recently used days are removed beyond it.')
+parser.add_argument('--sensitivity-cache',
+                    type=str,
+                    default='./sensitivity_cache.json',
+                    help='File of cached instrument sensitivities used with --response.')
+parser.add_argument('--sensitivity-ttl',
+                    type=float,
+                    default=7,
+                    help='Number of days before a cached instrument sensitivity is requested again.')
+parser.add_argument('--fetch-workers',
+                    type=int,
+                    default=8,
+                    help='Number of waveform requests to make at once across all streams and days.')
+parser.add_argument('--bulk',
+                    action='store_true',
+                    help='Whether to request the waveforms of all streams not in the waveform cache in one FDSN bulk '
+                         'request per day, each day calculated before the next is requested, falling back to single '
+                         'requests for any that fail.')
+parser.add_argument('--fetch-timing',
+                    action='store_true',
+                    help='Print the time spent setting up each FDSN client and in its requests.')
+parser.add_argument('--stream-chunk',
+                    type=float,
+                    help='Fetch and filter each day in chunks of this many hours, calculating the 10-minute windows of '
+                         'each chunk as it arrives so memory use depends on the chunk length rather than the day. '
+                         'Filters run continuously across chunks, as with --continuous-filter.')
+parser.add_argument('--min-coverage',
+                    type=float,
+                    help='Calculate RSAM on the contiguous segments of the data instead of interpolating across gaps, '
+                         'giving no value (NaN) to windows with less than this fraction of their samples. The '
+                         'coverage of each window is written to a .coverage file next to the RSAM files.')
+parser.add_argument('--aligned',
+                    action='store_true',
+                    help='Whether to calculate RSAM on 10-minute windows aligned to UTC clock time, so every RSAM file '
+                         'starts at midnight and holds the 144 windows of its day, with no value (NaN) for windows '
+                         'without enough data.')
+parser.add_argument('--store',
+                    action='store_true',
+                    help='Whether to also write the RSAM values of each day into the per stream and band store files '
+                         'of rsam_store.py, next to the day files.')
+parser.add_argument('--pyramid',
+                    action='store_true',
+                    help='Whether to also calculate 1-minute RSAM on windows aligned to UTC clock time, always '
+                         'filtering each day continuously, and roll it up into 10-minute, hourly and daily levels in '
+                         'the pyramid store files of rsam_store.py.')
+parser.add_argument('--plot-workers',
+                    type=int,
+                    help='Number of processes rendering the plots of the streams at once. Defaults to the number '
+                         'of CPUs.')
+parser.add_argument('--plot-formats',
+                    type=str,
+                    default='png',
+                    help='Comma-separated output formats of the plots: png for rendered images and/or json for the '
+                         'compact payload of the series and threshold zones drawn in a browser by rsam_viewer.html.')
+parser.add_argument('--plot-cache',
+                    type=str,
+                    default='./plot_cache',
+                    help='Directory keeping copies of the rendered plots, reused while the RSAM files and options of '
+                         'a plot are unchanged. Give an empty string to always render the plots.')
+parser.add_argument('--decimate',
+                    action='store_true',
+                    help='Whether to anti-alias decimate the data to the lowest sampling rate each frequency range '
+                         'allows before filtering it.')
+parser.add_argument('--decimate-check',
+                    action='store_true',
+                    help='Print the largest relative difference between decimated and full sampling rate RSAM values '
+                         'for each frequency range.')
 args = parser.parse_args()
+if args.min_coverage is not None and (args.continuous_filter or args.spectral or args.store_spectra or args.decimate or
+                                      args.stream_chunk):
+    parser.error('--min-coverage cannot be used with --continuous-filter, --spectral, --store-spectra, --decimate or '
+                 '--stream-chunk')
+if args.stream_chunk and (args.incremental or args.spectral or args.store_spectra or args.decimate or args.bulk):
+    parser.error('--stream-chunk cannot be used with --incremental, --spectral, --store-spectra, --decimate or --bulk')
+if args.pyramid and args.stream_chunk:
+    parser.error('--pyramid cannot be used with --stream-chunk')
+if args.aligned and (args.store_spectra or args.stream_chunk):
+    parser.error('--aligned cannot be used with --store-spectra or --stream-chunk')
+plot_formats = args.plot_formats.split(',')
+if set(plot_formats) - {'png', 'json'}:
+    parser.error('--plot-formats must be a comma-separated list of png and json')
 
 streams = args.streams.split(',')
 
+# Set up RSAM file extension, keeping spectral RSAM files apart from filtered RSAM files
+
+if args.spectral:
+    rsam_extension = '.spectral.rsam'
+    rsam_label = ' Hz spectral RSAM'
+else:
+    rsam_extension = '.rsam'
+    rsam_label = ' Hz RSAM'
+
+# Set up waveform cache
+
+if args.cache_dir:
+    cache = WaveformCache(args.cache_dir, max_bytes=args.cache_size * 1024 ** 3)
+else:
+    cache = None
+
+# Set up instrument sensitivity cache
+
+if args.response:
+    sensitivity_cache = SensitivityCache(args.sensitivity_cache, ttl=args.sensitivity_ttl * 86400)
+
 # Set up number of calculation/plot days
 
 num_plot_days = int(args.plot_days)
@@ -66,7 +196,10 @@ if args.calculate_plot_days:
 else:
     num_calculation_days = 1
 
-for n in range(num_calculation_days + 1):
+# Prepare RSAM calculation for each day and stream
+
+jobs = []
+for n in range(num_calculation_days, -1, -1):  # Oldest day first so filter state can carry between days
 
     # Set up timing
 
@@ -76,42 +209,14 @@ for n in range(num_calculation_days + 1):
 
     for stream in streams:
 
-        if stream.split('.')[0] == 'NZ':  # If the network is New Zealand
-            try:  # First try the near real time FDSN service for waveforms
-                client = Client('https://service-nrt.geonet.org.nz')
-                st = client.get_waveforms(network=stream.split('.')[0],
-                                          station=stream.split('.')[1],
-                                          location=stream.split('.')[2],
-                                          channel=stream.split('.')[3],
-                                          starttime=start,
-                                          endtime=end,
-                                          attach_response=True)
-                if st[0].stats.starttime - start > 600:
-                    raise Exception('Tried nrt service, start time of data and as requested differ by more than '
-                                    '10 minutes. Trying archive service...')
-            except:  # If this fails, try the archive FDSN service
-                try:
-                    client = Client('https://service.geonet.org.nz')
-                    st = client.get_waveforms(network=stream.split('.')[0],
-                                              station=stream.split('.')[1],
-                                              location=stream.split('.')[2],
-                                              channel=stream.split('.')[3],
-                                              starttime=start,
-                                              endtime=end,
-                                              attach_response=True)
-                except:  # If this fails, the data does not exist
-                    print('No data found for ' + stream + ' on date ' + str(start)[:10] + '\n')
-        else:
+        network, station, location, channel = stream.split('.')
+        if network != 'NZ':
             raise Exception('This code only has functionality for data from the NZ network.')
 
-        # Remove instrument response and ensure there are no gaps in the data
-
-        if args.response:
-            st.remove_sensitivity()
-        st.merge(fill_value='interpolate')
-
-        # Generate RSAM file
+        # Generate RSAM files
 
+        rsam_file_paths = []
+        bands = []
         frequency_ranges = args.filter_ranges.split('],[')
         for frequency_range in frequency_ranges:
             frequency_bounds = frequency_range.replace('[', '').replace(']', '').split(',')
@@ -120,117 +225,398 @@ for n in range(num_calculation_days + 1):
                   ' between dates ' + str(start)[:10] + ' and ' + str(end)[:10] +
                   ' between frequency bounds ' + frequency_bounds[0] + '-' + frequency_bounds[1] + ' Hz')
 
-            # Initialise data array
-
-            data = np.zeros(145)
-
             # Define RSAM file name
 
             if not frequency_bounds[0] and not frequency_bounds[1]:
                 filter_type = None
-                file_name = start.strftime("%Y.%j") + '.' + stream + '.rsam'
+                file_name = start.strftime("%Y.%j") + '.' + stream + rsam_extension
             elif frequency_bounds[0] and not frequency_bounds[1]:
                 filter_type = 'lowpass'
                 lower_bound = '%.2f' % float(frequency_bounds[0])  # String of lower frequency bound to 2 decimal places
-                file_name = start.strftime("%Y.%j") + '.' + stream + '.low_pass_' + lower_bound + '.rsam'
+                file_name = start.strftime("%Y.%j") + '.' + stream + '.low_pass_' + lower_bound + rsam_extension
             elif frequency_bounds[1] and not frequency_bounds[0]:
                 filter_type = 'highpass'
                 upper_bound = '%.2f' % float(frequency_bounds[1])  # String of upper frequency bound to 2 decimal places
-                file_name = start.strftime("%Y.%j") + '.' + stream + '.high_pass_' + upper_bound + '.rsam'
+                file_name = start.strftime("%Y.%j") + '.' + stream + '.high_pass_' + upper_bound + rsam_extension
             elif frequency_bounds[0] and frequency_bounds[1]:
                 filter_type = 'bandpass'
                 lower_bound = '%.2f' % float(frequency_bounds[0])  # String of lower frequency bound to 2 decimal places
                 upper_bound = '%.2f' % float(frequency_bounds[1])  # String of upper frequency bound to 2 decimal places
                 file_name = start.strftime("%Y.%j") + '.' + stream + '.band_pass_' + lower_bound + '-' + upper_bound + \
-                            '.rsam'
+                            rsam_extension
             rsam_data_path = './rsam_files/' + stream
-            rsam_file_path = rsam_data_path + '/' + file_name
-
-            # Make RSAM data folder if required
-
-            if not os.path.exists(rsam_data_path):
-                os.makedirs(rsam_data_path)
-
-            # Get metadata from stream
-
-            station = st[0].stats.station
-            network = st[0].stats.network
-            location = st[0].stats.location
-            channel = st[0].stats.channel
-            starttime = st[0].stats.starttime
-            endtime = st[0].stats.endtime
-
-            # Perform RSAM calculation
-
-            t = starttime
-            tr = st[0]
-            index = 0
-
-            # Loop through data in 600sec (10 min) blocks until loop goes through all data
-
-            while t < endtime:
-
-                tr_10m = tr.slice(t, t + 600)
-                duration = tr_10m.stats.npts * tr_10m.stats.delta
-
-                if duration >= 500:
-                    if duration < 600:
-                        tr_10m = tr.slice(endtime - 600, endtime)
+            rsam_file_paths.append(rsam_data_path + '/' + file_name)
 
-                    # Detrend and filter data
+            # Get filter parameters for the frequency range
 
-                    tr_10m.detrend(type='constant')
-
-                    if filter_type == 'lowpass':
-                        tr_10m.filter('lowpass',
-                                      freq=float(lower_bound),
-                                      corners=4,
-                                      zerophase=False)
-                    elif filter_type == 'highpass':
-                        tr_10m.filter('highpass',
-                                      freq=float(upper_bound),
-                                      corners=4,
-                                      zerophase=False)
-                    elif filter_type == 'bandpass':
-                        tr_10m.filter('bandpass',
-                                      freqmin=float(lower_bound),
-                                      freqmax=float(upper_bound),
-                                      corners=4,
-                                      zerophase=False)
-
-                    tr_10m.data = np.absolute(tr_10m.data)  # Convert data to absolute values
-                    mean = tr_10m.data.mean()  # Take mean of data (RSAM value)
-
-                    if args.response:
-                        mean = mean / 1e-9  # Convert data to nanometres so dealing with whole numbers
-
-                    # Assign RSAM value to data array
+            if filter_type == 'lowpass':
+                bands.append(('lowpass', float(lower_bound), None, None))
+            elif filter_type == 'highpass':
+                bands.append(('highpass', float(upper_bound), None, None))
+            elif filter_type == 'bandpass':
+                bands.append(('bandpass', None, float(lower_bound), float(upper_bound)))
+            else:
+                bands.append((None, None, None, None))
+
+        # Make RSAM data folder if required
+
+        if not os.path.exists(rsam_data_path):
+            os.makedirs(rsam_data_path)
+
+        # In incremental mode continue from the last complete window of the day's existing RSAM files, treating
+        # empty or unreadable files as missing
+
+        previous_data = None
+        first_window = None
+        if args.incremental:
+            previous_streams = [read_day_file(rsam_file_path) for rsam_file_path in rsam_file_paths]
+            previous_traces = [previous_st[0] if previous_st is not None else None for previous_st in previous_streams]
+            if None not in previous_traces and \
+                    len(set(str(previous_trace.stats.starttime) for previous_trace in previous_traces)) == 1 and \
+                    (not args.aligned or previous_traces[0].stats.starttime == start):
+                if args.aligned:  # Windows are complete up to the last one with a value
+                    complete_windows = min(len(np.trim_zeros(np.isfinite(previous_trace.data).astype(int), 'b'))
+                                           for previous_trace in previous_traces)
+                else:
+                    complete_windows = min(previous_trace.stats.npts for previous_trace in previous_traces)
+                previous_data = [previous_trace.data[:complete_windows] for previous_trace in previous_traces]
+                first_window = previous_traces[0].stats.starttime + 600 * complete_windows
+
+                # The day is complete once its last written window reaches the end of the day
+
+                if first_window >= end:
+                    print('RSAM values for ' + stream + ' on date ' + str(start)[:10] + ' are complete')
+                    continue
+
+                # Stored spectra are appended to as well, so the day is recalculated if they do not cover its windows
+
+                if args.store_spectra:
+                    spectra_file_path = rsam_data_path + '/' + start.strftime("%Y.%j") + '.' + stream + '.spectra.npz'
+                    if not os.path.isfile(spectra_file_path) or \
+                            load_spectra(spectra_file_path)[0] != previous_traces[0].stats.starttime or \
+                            len(load_spectra(spectra_file_path)[3]) < complete_windows:
+                        previous_data = None
+                        first_window = None
+
+        jobs.append({'stream': stream,
+                     'start': start,
+                     'rsam_data_path': rsam_data_path,
+                     'rsam_file_paths': rsam_file_paths,
+                     'bands': bands,
+                     'previous_data': previous_data,
+                     'previous_starttime': previous_traces[0].stats.starttime if previous_data is not None else None,
+                     'complete_windows': complete_windows if previous_data is not None else None,
+                     'first_window': first_window})
+
+
+# Optionally request the waveforms of each day's streams not in the waveform cache in one bulk request per FDSN service,
+# a day at a time so only one day of waveforms is held in memory
+
+
+def prefetch_day(day_jobs):
+    """
+    Request the waveforms of a day's jobs that are not in the waveform cache in bulk, keeping each in its job.
+    """
+    bulk_jobs = []
+    for job in day_jobs:
+        network, station, location, channel = job['stream'].split('.')
+        if job['first_window'] is None and cache is not None and \
+                os.path.isfile(cache.path(network, station, location, channel, job['start'])):
+            continue
+        bulk_jobs.append(job)
+    bulk_requests = []
+    for job in bulk_jobs:
+        network, station, location, channel = job['stream'].split('.')
+        if job['first_window'] is None:
+            bulk_start = job['start']
+        else:
+            bulk_start = job['first_window'] - WARMUP
+        bulk_requests.append((network, station, location, channel, bulk_start, job['start'] + 86400))
+    for job, st in zip(bulk_jobs, fetch_bulk(bulk_requests, workers=args.fetch_workers)):
+        job['prefetched'] = st
+
+
+def bulk_results():
+    """
+    Yield (job, fetch_job(job)) for each job, prefetching a day's waveforms only once the previous day is processed.
+    """
+    for _, day_jobs in groupby(jobs, key=lambda job: job['start'].timestamp):  # Jobs are in day order
+        day_jobs = list(day_jobs)
+        prefetch_day(day_jobs)
+        for result in fetch_concurrently(day_jobs, fetch_job, workers=args.fetch_workers, ordered=args.filter_state):
+            yield result
+
+# Get waveforms for all days and streams concurrently from the near real time FDSN service, or the archive FDSN service
+# if that fails, and calculate RSAM for each as it arrives. With saved filter state days are calculated in order. With
+# --stream-chunk each day is fetched and calculated chunk by chunk in the fetching threads
+
+
+def filter_state_files(job):
+    """
+    Return (previous day file, this day file) filter state paths for each band of a job.
+    """
+    state_files = []
+    for rsam_file_path in job['rsam_file_paths']:
+        state_file_path = rsam_file_path[:-len(rsam_extension)] + '.filter_state.npz'
+        previous_state_file_path = job['rsam_data_path'] + '/' + (job['start'] - 86400).strftime("%Y.%j") + \
+                                   state_file_path[len(job['rsam_data_path'] + '/') + 8:]
+        state_files.append((previous_state_file_path, state_file_path))
+    return state_files
+
+
+def fetch_job(job):
+    network, station, location, channel = job['stream'].split('.')
+    return fetch_since(network, station, location, channel, job['start'], job['first_window'], cache=cache,
+                       warmup=WARMUP, prefetched=job.pop('prefetched', None))  # Released once used
+
+
+def stream_job(job):
+    """
+    Fetch a day in chunks and return the stats of its data and its RSAM values, calculated as each chunk arrives.
+    """
+    network, station, location, channel = job['stream'].split('.')
+    state_files = filter_state_files(job) if args.filter_state else None
+    rsam = None
+    data_bank = []
+    for st in fetch_chunks(network, station, location, channel, job['start'], job['start'] + 86400,
+                           chunk=args.stream_chunk * 3600):
+        if args.response:
+            sensitivity_cache.remove_sensitivity(st)
+        st.merge(fill_value='interpolate')
+        tr = st[0]
+        if rsam is None:
+            sos_bank = [band_filter(band, tr.stats.sampling_rate) for band in job['bands']]
+            states = None
+            if state_files is not None:
+                states = [load_filter_state(state_file[0], tr, sos) for state_file, sos in zip(state_files, sos_bank)]
+            rsam = StreamingRSAM(sos_bank, states, state_time=job['start'] + 86400)
+        data_bank.append(rsam.add(tr))
+    if rsam is None:
+        return None, None
+    data_bank.append(rsam.finish())
+    if state_files is not None:
+        for state_file, sos, state in zip(state_files, sos_bank, rsam.end_states):
+            save_filter_state(state_file[1], state, rsam.stats, sos, job['start'] + 86400)
+    return rsam.stats, np.hstack(data_bank)
+
+
+def stream_chain(chain):
+    return [stream_job(job) for job in chain]
+
+
+if args.stream_chunk and args.filter_state:
+
+    # Days of a stream carry filter state, so each stream's days are calculated in order by one thread
+
+    chains = [[job for job in jobs if job['stream'] == stream] for stream in streams]
+    results = ((job, result) for chain, chain_results in fetch_concurrently(chains, stream_chain,
+                                                                            workers=args.fetch_workers)
+               for job, result in zip(chain, chain_results))
+elif args.stream_chunk:
+    results = fetch_concurrently(jobs, stream_job, workers=args.fetch_workers)
+elif args.bulk:
+    results = bulk_results()
+else:
+    results = fetch_concurrently(jobs, fetch_job, workers=args.fetch_workers, ordered=args.filter_state)
+for job, result in results:
+
+    stream = job['stream']
+    start = job['start']
+    rsam_data_path = job['rsam_data_path']
+    rsam_file_paths = job['rsam_file_paths']
+    bands = job['bands']
+    previous_data = job['previous_data']
+    first_window = job['first_window']
+
+    # In streaming mode RSAM values were calculated chunk by chunk as the data arrived
+
+    if args.stream_chunk:
+        data_stats, data_bank = result
+        if data_stats is None:  # The data does not exist
+            print('No data found for ' + stream + ' on date ' + str(start)[:10] + '\n')
+            continue
+        station = data_stats.station
+        network = data_stats.network
+        location = data_stats.location
+        channel = data_stats.channel
+        starttime = data_stats.starttime
+    else:
+        st, joined = result
+        if first_window is not None and not joined:
+            if st is not None:
+                print('New data for ' + stream + ' on date ' + str(start)[:10] + ' do not join onto existing RSAM '
+                      'values, recalculating the whole day')
+            previous_data = None
+            first_window = None
+        if st is None:  # The data does not exist
+            print('No data found for ' + stream + ' on date ' + str(start)[:10] + '\n')
+            continue
+
+        # Remove instrument response and ensure there are no gaps in the data, unless windows are calculated on the
+        # contiguous segments of the data
 
-                    data[index] = mean
-                    index += 1
+        if args.response:
+            sensitivity_cache.remove_sensitivity(st)
+        if args.min_coverage is None:
+            st.merge(fill_value='interpolate')
+        else:
+            st.sort(['starttime'])
 
-                t += 600
+        # Get metadata from stream
 
-            # Resize data array to remove any unused elements
+        station = st[0].stats.station
+        network = st[0].stats.network
+        location = st[0].stats.location
+        channel = st[0].stats.channel
+        if args.aligned:
+            starttime = start
+        elif previous_data is None:
+            starttime = st[0].stats.starttime
+        else:
+            starttime = job['previous_starttime']
+        endtime = max(trace.stats.endtime for trace in st)  # Segments are kept apart with --min-coverage
 
-            data = np.resize(data, index)
+        # Perform RSAM calculation over 600sec (10 min) blocks of the data for all frequency ranges at once. Only
+        # complete windows are calculated in incremental mode, so later updates can continue from them. Once the data
+        # reaches the end of the day its final window is calculated as without --incremental, so it is not left out
 
-            # Write RSAM file in miniSEED format
+        tr = st[0]
+        complete_only = args.incremental and endtime + tr.stats.delta < start + 86400
+        state_files = None
+        if args.filter_state and first_window is None:
+            state_files = filter_state_files(job)
+        day = start if args.aligned else None
+        if args.store_spectra:
+            edges = spectrum_edges(tr.stats.sampling_rate)
+            spectral_bank, binned = window_spectra(tr, bands if args.spectral else (), edges,
+                                                   first_window=first_window, complete_only=complete_only)
+            spectra_file_path = rsam_data_path + '/' + start.strftime("%Y.%j") + '.' + stream + '.spectra.npz'
+            if first_window is not None:  # Append the new windows' spectra to the day's stored spectra
+                binned = np.vstack([load_spectra(spectra_file_path)[3][:job['complete_windows']], binned])
+            save_spectra(spectra_file_path,
+                         tr,
+                         edges,
+                         binned,
+                         starttime=starttime)
+        elif args.spectral:
+            spectral_bank = spectral_bank_rsam(tr, bands, first_window=first_window, complete_only=complete_only,
+                                               day=day)
+        if args.spectral:
+            data_bank = spectral_bank
+        elif args.min_coverage is not None:
+            data_bank, coverage = gap_bank_rsam(st,
+                                                [band_filter(band, tr.stats.sampling_rate) for band in bands],
+                                                min_coverage=args.min_coverage,
+                                                first_window=first_window,
+                                                complete_only=complete_only,
+                                                day=day)
+        else:
+            data_bank = rsam_bands(tr,
+                                   bands,
+                                   decimate=args.decimate,
+                                   continuous=args.continuous_filter,
+                                   state_files=state_files,
+                                   first_window=first_window,
+                                   complete_only=complete_only,
+                                   day=day,
+                                   state_time=start + 86400)
+
+        # Calculate the finest pyramid level on its own clock-aligned windows
+
+        if args.pyramid:
+            base_window = PYRAMID_LEVELS[0]
+            base_min_duration = MIN_DURATION * base_window / WINDOW
+            if args.spectral:
+                base_bank = spectral_bank_rsam(tr, bands, window=base_window, min_duration=base_min_duration,
+                                               first_window=first_window, complete_only=complete_only, day=start)
+            elif args.min_coverage is not None:
+                base_bank = gap_bank_rsam(st,
+                                          [band_filter(band, tr.stats.sampling_rate) for band in bands],
+                                          min_coverage=args.min_coverage,
+                                          window=base_window,
+                                          min_duration=base_min_duration,
+                                          first_window=first_window,
+                                          complete_only=complete_only,
+                                          day=start)[0]
+            else:
+                base_bank = continuous_bank_rsam(tr,
+                                                 [band_filter(band, tr.stats.sampling_rate) for band in bands],
+                                                 window=base_window,
+                                                 min_duration=base_min_duration,
+                                                 first_window=first_window,
+                                                 complete_only=complete_only,
+                                                 day=start)[0]
+
+        if args.decimate_check:
+            for frequency_range, error in zip(frequency_ranges, decimation_accuracy(tr, bands)):
+                print('Largest relative difference of decimated RSAM for ' + stream + ' between frequency bounds ' +
+                      frequency_range.replace('[', '').replace(']', '') + ' Hz: ' + '%.4f' % error)
+
+    # Write RSAM files in miniSEED format
+
+    for m, (data, rsam_file_path) in enumerate(zip(data_bank, rsam_file_paths)):
+        if args.response:
+            data = data / 1e-9  # Convert data to nanometres so dealing with whole numbers
+        if previous_data is not None and args.aligned:
+            data = np.concatenate([previous_data[m], data[len(previous_data[m]):]])  # Fill in the day's new slots
+        elif previous_data is not None:
+            data = np.concatenate([previous_data[m], data])  # Append new windows to the day's existing values
+        if len(data) == 0:  # No complete window, e.g. less data than the minimum window duration
+            print('No RSAM values for ' + stream + ' on date ' + str(start)[:10] + ', not writing ' + rsam_file_path)
+            continue
+        delta = 600  # 10 min windows between RSAM values
+        stats = {'network': network,
+                 'station': station,
+                 'location': location,
+                 'channel': channel,
+                 'npts': len(data),
+                 'delta': delta,
+                 'mseed': {'dataquality': 'D'},
+                 'starttime': starttime}
+        out_st = Stream([Trace(data=data,
+                         header=stats)])
+        out_st.write(rsam_file_path,
+                     format='MSEED',
+                     reclen=256)
+        update_day_index(rsam_file_path, out_st[0])
+        if args.store:
+            RSAMStore(store_path(rsam_file_path)).write_trace(out_st[0])
+        if args.pyramid:
+            RSAMPyramid(rsam_file_path).write(start, base_bank[m] / 1e-9 if args.response else base_bank[m], stats)
+
+    # Write the data coverage of each window in miniSEED format
+
+    if args.min_coverage is not None and len(coverage):
+        coverage_file_path = rsam_data_path + '/' + start.strftime("%Y.%j") + '.' + stream + '.coverage'
+        if previous_data is not None:
+            previous_coverage = np.full(job['complete_windows'], np.nan)  # Unknown if the day had no coverage file
+            previous_coverage_st = read_day_file(coverage_file_path)
+            if previous_coverage_st is not None:
+                previous_coverage_trace = previous_coverage_st[0]
+                if previous_coverage_trace.stats.starttime == starttime:
+                    known = min(job['complete_windows'], previous_coverage_trace.stats.npts)
+                    previous_coverage[:known] = previous_coverage_trace.data[:known]
+            if args.aligned:
+                coverage = np.concatenate([previous_coverage, coverage[job['complete_windows']:]])
+            else:
+                coverage = np.concatenate([previous_coverage, coverage])
+        stats = {'network': network,
+                 'station': station,
+                 'location': location,
+                 'channel': channel,
+                 'npts': len(coverage),
+                 'delta': 600,
+                 'mseed': {'dataquality': 'D'},
+                 'starttime': starttime}
+        Stream([Trace(data=coverage,
+                      header=stats)]).write(coverage_file_path,
+                                            format='MSEED',
+                                            reclen=256)
 
-            delta = 600  # 10 min windows between RSAM values
-            stats = {'network': network,
-                     'station': station,
-                     'location': location,
-                     'channel': channel,
-                     'npts': len(data),
-                     'delta': delta,
-                     'mseed': {'dataquality': 'D'},
-                     'starttime': starttime}
-            out_st = Stream([Trace(data=data,
-                             header=stats)])
-            out_st.write(rsam_file_path,
-                         format='MSEED',
-                         reclen=256)
+if args.fetch_timing:
+    for service, (setup_time, num_requests, request_time) in sorted(client_timings().items()):
+        print('FDSN client for ' + service + ': set up in ' + '%.2f' % setup_time + ' s, ' + str(num_requests) +
+              ' requests in ' + '%.2f' % request_time + ' s')
 
 # Generate yearly RSAM files with daily mean RSAM values
 
@@ -246,58 +632,47 @@ for stream in streams:
 
         if not frequency_bounds[0] and not frequency_bounds[1]:
             filter_type = None
-            rsam_file_suffix = '.' + stream + '.rsam'
-            year_file_name = str(date.year) + '.' + stream + '.rsam'
+            rsam_file_suffix = '.' + stream + rsam_extension
+            year_file_name = str(date.year) + '.' + stream + rsam_extension
         elif frequency_bounds[0] and not frequency_bounds[1]:
             filter_type = 'lowpass'
             lower_bound = '%.2f' % float(frequency_bounds[0])  # String of lower frequency bound to 2 decimal places
-            rsam_file_suffix = '.' + stream + '.low_pass_' + lower_bound + '.rsam'
-            year_file_name = str(date.year) + '.' + stream + '.low_pass_' + lower_bound + '.rsam'
+            rsam_file_suffix = '.' + stream + '.low_pass_' + lower_bound + rsam_extension
+            year_file_name = str(date.year) + '.' + stream + '.low_pass_' + lower_bound + rsam_extension
         elif frequency_bounds[1] and not frequency_bounds[0]:
             filter_type = 'highpass'
             upper_bound = '%.2f' % float(frequency_bounds[1])  # String of upper frequency bound to 2 decimal places
-            rsam_file_suffix = '.' + stream + '.high_pass_' + upper_bound + '.rsam'
-            year_file_name = str(date.year) + '.' + stream + '.high_pass_' + upper_bound + '.rsam'
+            rsam_file_suffix = '.' + stream + '.high_pass_' + upper_bound + rsam_extension
+            year_file_name = str(date.year) + '.' + stream + '.high_pass_' + upper_bound + rsam_extension
         elif frequency_bounds[0] and frequency_bounds[1]:
             filter_type = 'bandpass'
             lower_bound = '%.2f' % float(frequency_bounds[0])  # String of lower frequency bound to 2 decimal places
             upper_bound = '%.2f' % float(frequency_bounds[1])  # String of upper frequency bound to 2 decimal places
-            rsam_file_suffix = '.' + stream + '.band_pass_' + lower_bound + '-' + upper_bound + '.rsam'
-            year_file_name = str(date.year) + '.' + stream + '.band_pass_' + lower_bound + '-' + upper_bound + '.rsam'
+            rsam_file_suffix = '.' + stream + '.band_pass_' + lower_bound + '-' + upper_bound + rsam_extension
+            year_file_name = str(date.year) + '.' + stream + '.band_pass_' + lower_bound + '-' + upper_bound + rsam_extension
         year_rsam_file = './rsam_files/' + stream + '/' + year_file_name
 
-        # Parse all RSAM files for the stream and frequency range and save their daily mean to the data array
+        # Take the daily mean of every RSAM file of the year so far from the daily summary index of the stream and
+        # frequency range, which is updated whenever a day file is written
 
+        starttime = UTCDateTime(date.year, 1, 1)
+        rsam_file_paths = ['./rsam_files/' + stream + '/' + (starttime + 86400 * n).strftime("%Y.%j") +
+                           rsam_file_suffix for n in range(int(date.strftime("%j")))]
         data = []
-        starttime = None
-        for jday in range(int(date.strftime("%j")) + 1):
-            rsam_file_path = './rsam_files/' + stream + '/' + str(date.year) + '.' + str(jday) + rsam_file_suffix
-
-            # If the RSAM file exists calculate the mean value for the day
-
-            if os.path.isfile(rsam_file_path):
-
-                # Read data file
-
-                st = read(rsam_file_path)
-
-                # In case stream has more than one trace, fill gaps
-
-                st.merge(fill_value='interpolate')
-                tr = st[0]
-                if not starttime:
-                    starttime = tr.stats.starttime
-
-                # Save mean value for the day
-
-                data.append(tr.data.mean())
-
+        summary = None
+        for rsam_file_path, day_summary in zip(rsam_file_paths, day_summaries(rsam_file_paths)):
+            if day_summary is not None:
+                summary = day_summary
+                data.append(np.nan if day_summary['mean'] is None else day_summary['mean'])  # NaN without values
             else:
 
                 # File does not exist, assign a value of -1 as day value
 
                 print("Can't find file %s" % rsam_file_path)
                 data.append(-1)
+        if summary is None:
+            print('No RSAM files found for ' + stream + ' in ' + str(date.year))
+            continue
 
         # If a yearly RSAM file exists already, delete it
 
@@ -306,11 +681,10 @@ for stream in streams:
 
         # Start a new yearly RSAM file
 
-        station = tr.stats.station
-        network = tr.stats.network
-        location = tr.stats.location
-        channel = tr.stats.channel
-        starttime = starttime
+        station = summary['station']
+        network = summary['network']
+        location = summary['location']
+        channel = summary['channel']
         delta = 86400  # One day interval
         npts = len(data)  # Number of days
         stats = {'network': network,
@@ -332,20 +706,23 @@ for stream in streams:
 if not os.path.exists('./output/'):
     os.makedirs('./output')
 
-# Plot RSAM data
+# Gather RSAM data for plotting, reading each day file once for all plots
 
+reader = RSAMReader('./rsam_files', extension=rsam_extension)
+plot_cache = PlotCache(args.plot_cache) if args.plot_cache else None
+plots = []
+plot_fingerprints = {}
 for stream in streams:
 
     # Set plot dates
 
-    yd1 = date2num(date - datetime.timedelta(days=num_plot_days)) + 1
-    yd2 = date2num(date)
-    dates = num2date(np.arange(yd1, yd2, 1))
+    plot_start = date - datetime.timedelta(days=num_plot_days - 1)
+    plot_end = date
 
     # Gather data for plotting
 
     frequency_ranges = args.filter_ranges.split('],[')
-    frequency_banded_traces = []
+    bands = []
     for frequency_range in frequency_ranges:
         frequency_bounds = frequency_range.replace('[', '').replace(']', '').split(',')
 
@@ -353,152 +730,72 @@ for stream in streams:
               ' between dates ' + str(date - datetime.timedelta(days=num_plot_days))[:10] + ' and ' + str(date)[:10] +
               ' between frequency bounds ' + frequency_bounds[0] + '-' + frequency_bounds[1] + ' Hz')
 
-        st = Stream()  # Create empty stream to fill with RSAM data over many days
-        for d in dates:
+        # Get RSAM file name band for the frequency range
 
-            # Get RSAM file name for the date
-
-            yd = d.strftime("%Y.%j")
-            if not frequency_bounds[0] and not frequency_bounds[1]:
-                filter_type = None
-                file_name = d.strftime("%Y.%j") + '.' + stream + '.rsam'
-            elif frequency_bounds[0] and not frequency_bounds[1]:
-                filter_type = 'lowpass'
-                lower_bound = '%.2f' % float(frequency_bounds[0])  # String of lower frequency bound to 2 decimal places
-                file_name = d.strftime("%Y.%j") + '.' + stream + '.low_pass_' + lower_bound + '.rsam'
-            elif frequency_bounds[1] and not frequency_bounds[0]:
-                filter_type = 'highpass'
-                upper_bound = '%.2f' % float(frequency_bounds[1])  # String of upper frequency bound to 2 decimal places
-                file_name = d.strftime("%Y.%j") + '.' + stream + '.high_pass_' + upper_bound + '.rsam'
-            elif frequency_bounds[0] and frequency_bounds[1]:
-                filter_type = 'bandpass'
-                lower_bound = '%.2f' % float(frequency_bounds[0])  # String of lower frequency bound to 2 decimal places
-                upper_bound = '%.2f' % float(frequency_bounds[1])  # String of upper frequency bound to 2 decimal places
-                file_name = d.strftime("%Y.%j") + '.' + stream + '.band_pass_' + lower_bound + '-' + upper_bound + \
-                            '.rsam'
-
-            # Process RSAM file
-
-            if os.path.isfile('./rsam_files/' + stream + '/' + file_name):
-                st += read('./rsam_files/' + stream + '/' + file_name)
-
-        # Merge all RSAM data to a single stream
-
-        st.merge(fill_value='interpolate')
-        tr = st[0]
+        if not frequency_bounds[0] and not frequency_bounds[1]:
+            band = ''
+        elif frequency_bounds[0] and not frequency_bounds[1]:
+            lower_bound = '%.2f' % float(frequency_bounds[0])  # String of lower frequency bound to 2 decimal places
+            band = 'low_pass_' + lower_bound
+        elif frequency_bounds[1] and not frequency_bounds[0]:
+            upper_bound = '%.2f' % float(frequency_bounds[1])  # String of upper frequency bound to 2 decimal places
+            band = 'high_pass_' + upper_bound
+        elif frequency_bounds[0] and frequency_bounds[1]:
+            lower_bound = '%.2f' % float(frequency_bounds[0])  # String of lower frequency bound to 2 decimal places
+            upper_bound = '%.2f' % float(frequency_bounds[1])  # String of upper frequency bound to 2 decimal places
+            band = 'band_pass_' + lower_bound + '-' + upper_bound
+
+        bands.append(band)
+
+    # Reuse the stream's cached plot if its RSAM files and options are unchanged
+
+    plot_path = './output/' + stream.split('.')[1] + '.rsam_plot_' + str(num_plot_days) + '_days.png'
+    plot_outputs = [os.path.splitext(plot_path)[0] + '.' + plot_format for plot_format in plot_formats]
+    if plot_cache is not None:
+        plot_parameters = {'path': plot_path, 'stream': stream, 'bands': bands, 'extension': rsam_extension,
+                           'start': str(plot_start), 'end': str(plot_end), 'base_trig': args.base_trig,
+                           'formats': plot_formats}
+        fingerprint = plot_cache.fingerprint(plot_parameters,
+                                             [path for band in bands
+                                              for path in reader.paths(stream, band, plot_start, plot_end,
+                                                                       pixels=plot_pixels())] +
+                                             [os.path.abspath(__file__), rsam_render.__file__, rsam_reader.__file__,
+                                              rsam_store.__file__])
+        if plot_cache.fetch(plot_parameters, fingerprint, plot_outputs):
+            print('Inputs unchanged, reusing ' + ', '.join(plot_outputs))
+            continue
+        plot_fingerprints[plot_path] = (plot_parameters, fingerprint, plot_outputs)
+
+    # Put times and values into frequency banded list of series, read from the coarsest RSAM pyramid level resolving
+    # the plot where --pyramid has written one
+
+    frequency_banded_series = [reader.read(stream, band, plot_start, plot_end, pixels=plot_pixels())
+                               for band in bands]
+
+    # Write the stream's plot payload and queue its plot for rendering
+
+    plot = {'path': plot_path,
+            'title': 'Real-Time Seismic Amplitude (RSAM: a measure of seismic energy) at Whakaari/White Island '
+                     'in the last ' + str(num_plot_days) + ' days',
+            'base_trig': args.base_trig,
+            'dpi': 400,
+            'series': [(times, data,
+                        frequency_ranges[n].replace('[', '').split(',')[0] + '-' +
+                        frequency_ranges[n].replace(']', '').split(',')[1] + rsam_label,
+                        linestyles[n])
+                       for n, (times, data) in enumerate(frequency_banded_series)]}
+    if 'json' in plot_formats:
+        payload_path, write_time = write_plot_payload(plot, os.path.splitext(plot_path)[0] + '.json')
+        print('Wrote ' + payload_path + ' in ' + '%.2f' % write_time + ' s')
+    if 'png' in plot_formats:
+        plots.append(plot)
+    elif plot_path in plot_fingerprints:
+        plot_cache.store(*plot_fingerprints[plot_path])
+
+# Render the plots of all streams in parallel, each figure released after it is saved
+
+for plot_path, render_time, memory in render_plots(plots, workers=args.plot_workers):
+    print('Rendered ' + plot_path + ' in ' + '%.2f' % render_time + ' s, using ' + '%.0f' % memory + ' MB')
+    if plot_path in plot_fingerprints:
+        plot_cache.store(*plot_fingerprints[plot_path])
 
-        # Put stream into frequency banded list of streams
-
-        frequency_banded_traces.append(tr)
-
-    # Prepare figure and axis
-
-    fig = plt.figure(figsize=(15,
-                              5))
-    plt.axes([0.1,
-              0.2,
-              0.85,
-              0.7])
-
-    # Add base trigger level on plot
-
-    if args.base_trig != 'null':
-        bt = float(args.base_trig)
-        half = bt / 2
-        plt.axhline(y=bt,
-                    linestyle='--',
-                    color='red',
-                    label='RSAM alert value')
-
-        # Colour areas based on relation to BTL
-
-        plt.axhspan(0,
-                    half,
-                    alpha=0.1,
-                    color='green',
-                    label='Weak RSAM zone')  # Weak rectangle
-        plt.axhspan(half,
-                    bt,
-                    alpha=0.1,
-                    color='orange',
-                    label='Moderate RSAM zone')  # Moderate rectangle
-        plt.axhspan(bt,
-                    100000,
-                    alpha=0.1,
-                    color='red',
-                    label='Strong RSAM zone')  # Strong rectangle
-
-    # Plot data
-
-    for n in range(len(frequency_banded_traces)):
-
-        # Prepare start and end time for plotting
-
-        start = date2num(frequency_banded_traces[n].stats.starttime.datetime)
-        end = date2num(frequency_banded_traces[n].stats.endtime.datetime)
-
-        # Build plot ticks
-
-        plot_range = (frequency_banded_traces[n].stats.endtime.datetime -
-                      frequency_banded_traces[n].stats.starttime.datetime).total_seconds() / 86400
-        tick_range = math.ceil(plot_range)
-        second_offset = 86400 - (frequency_banded_traces[n].stats.starttime.datetime.hour * 3600 +
-                                 frequency_banded_traces[n].stats.starttime.datetime.minute * 60 +
-                                 frequency_banded_traces[n].stats.starttime.datetime.second +
-                                 frequency_banded_traces[n].stats.starttime.datetime.microsecond / 1000000)
-        xticks = []
-        xtick_labels = []
-        for m in range(tick_range):
-            xticks.append((frequency_banded_traces[n].stats.starttime.datetime +
-                           datetime.timedelta(seconds=second_offset) +
-                           datetime.timedelta(days=m)).astimezone(pytz.timezone('Pacific/Auckland')).date())
-            if m % 2 == 0:
-                xtick_labels.append(str(xticks[-1]))
-            else:
-                xtick_labels.append('')
-
-        # Set time values
-
-        t = sp.linspace(start,
-                        end,
-                        frequency_banded_traces[n].stats.npts)
-
-        plt.plot_date(t,
-                      frequency_banded_traces[n].data,
-                      linewidth=1,
-                      linestyle=linestyles[n],
-                      marker='None',
-                      color='black',
-                      label=frequency_ranges[n].replace('[', '').split(',')[0] + '-' +
-                            frequency_ranges[n].replace(']', '').split(',')[1] + ' Hz RSAM')
-
-        # Add plot features
-
-        plt.title('Real-Time Seismic Amplitude (RSAM: a measure of seismic energy) at Whakaari/White Island in the last ' +
-                  str(num_plot_days) + ' days',
-                  y=1.03,
-                  fontdict={'fontsize': 14})
-        plt.yticks(plt.gca().get_yticks(),
-                   fontsize=12)
-        plt.ylabel('ground velocity (nm/s)',
-                   fontsize=14,
-                   labelpad=10)
-        plt.ylim(bottom=0,
-                 top=1.1 * frequency_banded_traces[n].data.max())
-        plt.xticks(ticks=xticks,
-                   labels=xtick_labels,
-                   rotation=30,
-                   ha='right',
-                   fontsize=12)
-        plt.xlabel('date (NZT)',
-                   fontsize=14,
-                   labelpad=5)
-        plt.xlim(t[0],
-                 t[-1])
-        plt.legend(loc='upper left')
-
-    # Save plot to file
-
-    plt.savefig('./output/' + stream.split('.')[1] + '.rsam_plot_' + str(num_plot_days) + '_days.png',
-                dpi=400,
-                fmt='png')